@@ -17,16 +17,73 @@
 #           output_name  Where to store the results (path to CSV file)
 #           -of ORIGINALS_FOLDER  Folder to save original html files. Skip saving if empty.
 #           --cache_only only parse cache, do not touch the web site
+#           --compress METHOD store pages in the originals folder compressed: none (default), gzip, zstd;
+#               pages are read in any of these formats regardless of the option
+#           --store STORE how pages are kept in the originals folder:
+#               files -- one file per house (default)
+#               pack -- appended to large pack files (--pack_shards, --pack_size MB) with an index in pack/index.sqlite
+#           --migrate_to_pack move pages from the files of the originals folder into the pack store and quit
+#           --rebuild_manifest classify all cached pages, record them in the manifest (cache.sqlite) and quit;
+#               once the manifest is complete --fast_check and --allfiles take the state of the cache from it
+#           --cache_max_size SIZE, --cache_max_age DAYS  keep the originals folder within SIZE (e.g. 500M, 20G)
+#               evicting the least recently used pages over the quota and the pages older than DAYS; only
+#               pages without valid data (captcha, error pages etc.), leftovers and replaced copies are evicted,
+#               and with --history the valid pages kept in history.sqlite too (--cache_only reads them from there).
+#               Other valid pages are never removed: the run stops with exit code 4 if the quota cannot be kept
+#               without them. When the download goes over the quota the folder is freed down to 90% of it.
+#               Needs the manifest
+#           --slim_cache save only the parts of the house pages read by the extractors (address, div.fr,
+#               div.numbered, the map script) with a comment holding the address and fetch time of the page
+#           --full_pages refetch the full pages of the buildings cached with --slim_cache
+#           --fsck       classify every cached page in --jobs processes (default: number of cores) as the main loop
+#               does, record the results in the manifest, write fsck.csv (house_id, status, size, location)
+#               and refetch.txt with the buildings whose pages are not valid, then quit;
+#               --quarantine moves these pages to the quarantine folder of the originals folder
+#           --jobs N     with --cache_only or --allfiles extract the data of the cached pages in N processes,
+#               the results are written by the main process in the order of the buildings (default 1)
+#           --houseids_file FILE process the buildings listed in FILE (one house_id per line), e.g. refetch.txt
+#           --history    keep every version of the valid house pages retrieved from the site in history.sqlite
+#               of the originals folder, as deltas against the previous version
+#           --as_of DATE extract the data from the versions of the pages in effect at DATE (YYYY-MM-DD[ HH:MM:SS]),
+#               works with the cache only; with --allfiles all the buildings in the history are processed
+#           --cache_maint apply --cache_max_size and --cache_max_age to the originals folder, compact the packs and quit
 #           --no_tor do not use tor, connect to the site directly
+#           --site URL   address of the site (default http://www.reformagkh.ru), e.g. reformagkh_stub_server.py
 #           --extractor EXTRACTOR specify which data extractor to use:
 #               none -- do not use any data extractor, only read/download pages
 #               original -- use data extractor from the original project (limited set of variables, default)
 #               attrlist -- use data extractor and attribute list loaded from tsv file
+#               lxml -- the same output as original, pages are parsed by lxml with precompiled XPath (faster)
+#           --verify_extractor with --extractor lxml also run the original extractor and report the differences
 #           --outputformat FORMAT specify output format
 #               csv -- CSV (default)
 #               sqlite -- sqlite database (only implemented for attrlist data extractor)
 #               pg --
 #           --reload_list reload list of the buildings from the site even if cache file exixts
+#           --list_ttl DAYS reload cached list of the buildings older than DAYS (default: never)
+#               a reloaded list is compared with the cached one: new buildings are processed first,
+#               removed ones are appended to <output name>-removed.csv next to the output
+#               (house_id, tid, date; removed.csv in the originals folder for pg output and extractor none)
+#           --delta_only after reloading the list process only the buildings new in it
+#           --schedule ORDER order in which the buildings are processed:
+#               list -- as in the list of the buildings (default)
+#               shuffle -- random order, same as --shuffle
+#               staleness -- never fetched first, then the oldest cached pages, then the ones failed before;
+#                            all regions are scheduled together and interleaved
+#           --incremental revalidate only cached pages older than --max_age days, using conditional requests
+#                        and the last update dates from the list of the buildings when the site provides them
+#           --workers N  number of house pages to download concurrently (default 1, sequential)
+#           --socks_port, --torctl_port  tor socks and control ports (default 9150 and 9151)
+#           --tor_instances SOCKS:CTL,... use several tor daemons, e.g. 9150:9151,9160:9161
+#           --max_latency, --max_captcha_rate  tor circuit is replaced when its average latency (s) or captcha rate
+#                        after --min_circuit_requests requests exceeds these limits
+#           --connect_timeout, --read_timeout  timeouts in seconds for the direct (--no_tor) connections
+#           --retries N  attempts per request (default 5), --backoff initial and --backoff_max maximal pause
+#                        between the attempts, --retry_budget retries allowed in the run; houses which could not
+#                        be retrieved are deferred and retried once at the end of the region
+#           --aimd       adapt request rate of each tor circuit (or the direct connection) to the site limiter:
+#                        --rate initial, --min_rate, --max_rate requests per second,
+#                        --rate_increase added on success, --rate_decrease multiplier on captcha, 502 or time out
 # Examples:
 #      python get_reformagkh_data-v2.py 2280999 data/housedata2.csv -o html_orig
 #      python get_reformagkh_data-all.py 2291922 housedata.csv -of omsk --no_tor --cache_only
@@ -55,19 +112,29 @@
 #******************************************************************************
 
 from bs4 import BeautifulSoup
-import urllib2
+import bs4
+try:
+    import soupsieve # BeautifulSoup 4.7+ matches selectors with it, then the attrlist selectors are compiled once
+except ImportError:
+    soupsieve = None
+if soupsieve and tuple(int(v) for v in bs4.__version__.split('.')[:2]) < (4, 7):
+    soupsieve = None # older BeautifulSoup has its own selector matching
+import requests
 import csv
 #from progressbar import *
 from httplib import BadStatusLine,IncompleteRead
 import socket
+import errno
 import argparse
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 from time import sleep
 import requesocks
 from stem import Signal
 from stem.control import Controller
 # module to serialize/deserialize object on the disk
 import pickle
+import array
 import shutil
 import datetime
 import re
@@ -82,25 +149,92 @@ import time
 import os, glob
 import sys
 import random
+import gzip
+import zlib
+import struct
+import difflib
+import marshal
+import hashlib
+try:
+    import zstandard # optional, only needed for --compress zstd
+except ImportError:
+    zstandard = None
+try:
+    import lxml.html # optional, only needed for --extractor lxml
+    import lxml.etree
+except ImportError:
+    lxml = None
+import threading
+import multiprocessing
+import Queue
+
+def size_arg(value):
+    """Parses size with an optional K, M or G suffix"""
+    mtch = re.match(r'^(\d+(?:\.\d+)?)([KMG]?)B?$', value.strip().upper())
+    if not mtch:
+        raise argparse.ArgumentTypeError('invalid size: ' + value)
+    return int(float(mtch.group(1)) * 1024 ** ' KMG'.index(mtch.group(2) or ' '))
 
 parser = argparse.ArgumentParser()
 parser.add_argument('id', help='Region (default) or house ID')
 parser.add_argument('output_name', help='Where to store the results (path to output file or database URI)')
 parser.add_argument('-of','--originals_folder', help='Folder to save original html files. Skip saving if empty.')
+parser.add_argument('--site', help='address of the site', default='http://www.reformagkh.ru')
 parser.add_argument('--no_tor', help='Do not use tor connection', action="store_true")
 parser.add_argument('--cache_only', help='Do not connect to the web site, use only cached entries', action="store_true")
-parser.add_argument('--extractor', help='Data extractor to use', default='original', choices=['original', 'attrlist', 'none'])
+parser.add_argument('--compress', help='compression of the pages saved in the originals folder', default='none', choices=['none', 'gzip', 'zstd'])
+parser.add_argument('--store', help='how pages are kept in the originals folder', default='files', choices=['files', 'pack'])
+parser.add_argument('--pack_shards', help='number of pack files appended in parallel by the pack store', type=int, default=16)
+parser.add_argument('--pack_size', help='size of a pack file after which a new one is started, MB', type=int, default=1024)
+parser.add_argument('--migrate_to_pack', help='move pages of the originals folder into the pack store', action="store_true")
+parser.add_argument('--rebuild_manifest', help='classify all cached pages and record them in the manifest', action="store_true")
+parser.add_argument('--cache_max_size', help='quota of the originals folder, bytes or with K, M, G suffix', type=size_arg)
+parser.add_argument('--cache_max_age', help='evict pages without valid data (or kept in the history with --history) older than this number of days', type=float)
+parser.add_argument('--slim_cache', help='save only the parts of the house pages read by the extractors', action="store_true")
+parser.add_argument('--full_pages', help='refetch full pages of the buildings cached slim', action="store_true")
+parser.add_argument('--fsck', help='classify all cached pages, write fsck.csv and refetch.txt', action="store_true")
+parser.add_argument('--quarantine', help='with --fsck move the pages which are not valid to the quarantine folder', action="store_true")
+parser.add_argument('--jobs', help='number of processes for --fsck (default is the number of cores) and for the extraction from the cache (default 1)', type=int)
+parser.add_argument('--houseids_file', help='process the buildings listed in the file')
+parser.add_argument('--history', help='keep all versions of the pages retrieved', action="store_true")
+parser.add_argument('--as_of', help='extract the data from the versions of the pages in effect at this date')
+parser.add_argument('--cache_maint', help='apply the cache quota, compact the packs and quit', action="store_true")
+parser.add_argument('--extractor', help='Data extractor to use', default='original', choices=['original', 'attrlist', 'lxml', 'none'])
+parser.add_argument('--verify_extractor', help='compare output of the lxml extractor with the original one', action="store_true")
 parser.add_argument('--parser', help='HTML Parser to use', default='html.parser', choices=['html.parser', 'lxml'])
 parser.add_argument('--outputformat', help='output format', default='csv', choices=['csv', 'sqlite', 'pg'])
 parser.add_argument('--outputmode', help='output mode', default='append', choices=['append', 'overwrite'])
 parser.add_argument('--reload_list', help='reload list of the buildings even if cache file exixts', action="store_true")
+parser.add_argument('--list_ttl', help='reload cached list of the buildings older than this number of days', type=float)
+parser.add_argument('--delta_only', help='after reloading the list process only new buildings', action="store_true")
 parser.add_argument('--shuffle', help='shuffle list of the buildings', action="store_true")
+parser.add_argument('--schedule', help='order in which the buildings are processed', default='list', choices=['list', 'shuffle', 'staleness'])
 parser.add_argument('--fast_check', help='do not check for captcha, etc. in cahced files', action="store_true")
 parser.add_argument('--attrlist', help='The list of attributes with selectors to be extracted from HTML', default='attrlist.tsv')
 parser.add_argument('--houseid', help='provided id will be understood as house_id (single page will be processed)', action="store_true")
 parser.add_argument('--allfiles', help='process all files in the cache', action="store_true")
-#parser.add_argument('--socks_port', help='Tor sock port to connect to', default='9150')
-#parser.add_argument('--torctl_port', help='Tor control port to connect to', default='9151')
+parser.add_argument('--incremental', help='revalidate cached pages older than --max_age days', action="store_true")
+parser.add_argument('--max_age', help='age of a cached page in days after which --incremental revalidates it', type=float, default=30)
+parser.add_argument('--workers', help='number of house pages to download concurrently', type=int, default=1)
+parser.add_argument('--socks_port', help='Tor sock port to connect to', default='9150')
+parser.add_argument('--torctl_port', help='Tor control port to connect to', default='9151')
+parser.add_argument('--torctl_password', help='Tor control port password', default='password')
+parser.add_argument('--connect_timeout', help='connect timeout for the direct connections, seconds', type=float, default=10)
+parser.add_argument('--read_timeout', help='read timeout for the direct connections, seconds', type=float, default=300)
+parser.add_argument('--retries', help='number of attempts to retrieve a page', type=int, default=5)
+parser.add_argument('--backoff', help='pause before the first retry, seconds, doubled for each next retry', type=float, default=3)
+parser.add_argument('--backoff_max', help='maximal pause between retries, seconds', type=float, default=120)
+parser.add_argument('--retry_budget', help='total number of retries allowed in the run', type=int, default=1000)
+parser.add_argument('--aimd', help='adapt request rate to the site limiter (additive increase, multiplicative decrease)', action="store_true")
+parser.add_argument('--rate', help='initial request rate per tor circuit for --aimd, requests per second', type=float, default=1.0)
+parser.add_argument('--min_rate', help='minimal request rate for --aimd, requests per second', type=float, default=0.05)
+parser.add_argument('--max_rate', help='maximal request rate for --aimd, requests per second', type=float, default=5.0)
+parser.add_argument('--rate_increase', help='request rate increase after a good page for --aimd', type=float, default=0.05)
+parser.add_argument('--rate_decrease', help='request rate multiplier after captcha, 502 or time out for --aimd', type=float, default=0.5)
+parser.add_argument('--max_latency', help='replace tor circuit when its average request latency exceeds this, seconds', type=float, default=30)
+parser.add_argument('--max_captcha_rate', help='replace tor circuit when its share of captcha pages exceeds this', type=float, default=0.2)
+parser.add_argument('--min_circuit_requests', help='number of requests before tor circuit health is judged', type=int, default=10)
+parser.add_argument('--tor_instances', help='comma separated list of SOCKS_PORT:CONTROL_PORT pairs of tor daemons to spread the requests across, overrides --socks_port and --torctl_port')
 args = parser.parse_args()
 dirsep = '/' if not os.name == 'nt' else '\\'
 
@@ -109,6 +243,9 @@ if args.originals_folder:
     if not args.originals_folder.endswith(dirsep): args.originals_folder = args.originals_folder + dirsep
     if not os.path.exists(args.originals_folder): os.mkdir(args.originals_folder)
     region_name = args.originals_folder[:-1]
+if args.allfiles and not args.cache_only:
+    print '--allfiles imply --cache_only'
+    args.cache_only = True
 if args.cache_only:
     if not args.originals_folder:
         print 'cache-only requested but originals folder was not specified, quitting...'
@@ -120,7 +257,52 @@ if args.cache_only:
         print 'with cache_only no_tor has no effect'
     else:
         args.no_tor = True
-if args.outputformat == 'sqlite' and args.extractor == 'original':
+if args.migrate_to_pack:
+    if not args.originals_folder:
+        print '--migrate_to_pack requires originals folder'
+        sys.exit(-1)
+    args.store = 'pack'
+    args.cache_only = args.no_tor = True # the site is not needed
+if args.rebuild_manifest:
+    if not args.originals_folder:
+        print '--rebuild_manifest requires originals folder'
+        sys.exit(-1)
+    args.cache_only = args.no_tor = True # the site is not needed
+if args.full_pages and args.cache_only:
+    print '--full_pages and --cache_only cannot be used together'
+    sys.exit(-1)
+if args.as_of:
+    try:
+        as_of = time.mktime(time.strptime(args.as_of, '%Y-%m-%d %H:%M:%S' if ':' in args.as_of else '%Y-%m-%d'))
+    except ValueError:
+        print '--as_of expects YYYY-MM-DD or YYYY-MM-DD HH:MM:SS'
+        sys.exit(-1)
+    if ':' not in args.as_of:
+        as_of += 86400 # the end of the day
+    if not args.originals_folder:
+        print '--as_of requires originals folder'
+        sys.exit(-1)
+    args.cache_only = args.no_tor = True
+if args.fsck:
+    if not args.originals_folder:
+        print '--fsck requires originals folder'
+        sys.exit(-1)
+    args.cache_only = args.no_tor = True # the site is not needed
+if args.cache_maint:
+    if not args.originals_folder:
+        print '--cache_maint requires originals folder'
+        sys.exit(-1)
+    args.cache_only = args.no_tor = True # the site is not needed
+if args.compress == 'zstd' and zstandard is None:
+    print '--compress zstd requires zstandard module (pip install zstandard)'
+    sys.exit(-1)
+if args.extractor == 'lxml' and lxml is None:
+    print '--extractor lxml requires lxml module (pip install lxml)'
+    sys.exit(-1)
+if args.verify_extractor and args.extractor != 'lxml':
+    print '--verify_extractor requires --extractor lxml'
+    sys.exit(-1)
+if args.outputformat == 'sqlite' and args.extractor in ('original', 'lxml'):
         print 'sqlite outputformat works only for attrlist data extractor'
         sys.exit(-1)
 if args.extractor == 'none' and args.outputformat != 'csv':
@@ -128,9 +310,45 @@ if args.extractor == 'none' and args.outputformat != 'csv':
 if args.fast_check and args.extractor != 'none':
     print 'fast_check only allowed when extractor=none'
     sys.exit(5)
-if args.allfiles and not args.cache_only:
-    print '--allfiles imply --cache_only'
-    args.cache_only = True
+if args.incremental and (args.cache_only or not args.originals_folder):
+    print '--incremental requires originals folder and is not compatible with --cache_only'
+    sys.exit(-1)
+if args.retries < 1:
+    print '--retries must be a positive number'
+    sys.exit(-1)
+if args.shuffle:
+    args.schedule = 'shuffle'
+if args.schedule == 'staleness' and not args.originals_folder:
+    print '--schedule staleness requires originals folder'
+    sys.exit(-1)
+if args.pack_shards < 1:
+    print '--pack_shards must be a positive number'
+    sys.exit(-1)
+if args.workers < 1:
+    print '--workers must be a positive number'
+    sys.exit(-1)
+if args.jobs is not None and args.jobs < 1:
+    print '--jobs must be a positive number'
+    sys.exit(-1)
+# data of the cached pages is extracted in --jobs processes (see extract_houses)
+parallel_extraction = bool((args.jobs or 1) > 1 and args.cache_only and args.extractor != 'none' and not args.as_of and not args.verify_extractor)
+if args.aimd and not (0 < args.min_rate <= args.rate <= args.max_rate and 0 < args.rate_decrease < 1):
+    print '--aimd requires 0 < min_rate <= rate <= max_rate and 0 < rate_decrease < 1'
+    sys.exit(-1)
+
+if args.tor_instances:
+    try:
+        tor_endpoints = [ tuple(int(p) for p in pair.split(':')) for pair in args.tor_instances.split(',') ]
+        assert all(len(pair) == 2 for pair in tor_endpoints)
+    except (ValueError, AssertionError):
+        print '--tor_instances must look like 9150:9151,9160:9161'
+        sys.exit(-1)
+else:
+    tor_endpoints = [ (int(args.socks_port), int(args.torctl_port)) ]
+
+# locks shared by the download workers (see process_houses)
+output_lock = threading.Lock() # serializes data extraction and writing of the results
+thread_data = threading.local() # thread_data.tor is the tor instance used by the last request of the thread
 
 def console_out(text):
     #write httplib error messages to console
@@ -139,53 +357,566 @@ def console_out(text):
 
     f_errors.write(timestamp + ': '+ text)
 
-def get_content(link):
-    numtries = 5
-    timeoutvalue = 40
+class Timings(object):
+    """Accumulates time spent in the stages of the page processing, printed at the end of the run"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.counts = {}
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start)
+
+    def add(self, stage, seconds):
+        """Adds time measured elsewhere, e.g. in a worker process"""
+        with self.lock:
+            self.totals[stage] = self.totals.get(stage, 0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        pages = self.counts.get('parse', 0)
+        return 'pages=%d elapsed=%.2fs pages/s=%.2f fetch=%.2fs parse=%.2fs extract=%.2fs write=%.2fs' % (
+            pages, elapsed, pages / elapsed if elapsed else 0, self.totals.get('fetch', 0), self.totals.get('parse', 0),
+            self.totals.get('extract', 0) - self.totals.get('write', 0), self.totals.get('write', 0)) + \
+            (' slim=%.2fs' % self.totals['slim'] if 'slim' in self.totals else '')
+
+timings = Timings()
+
+def get_content(link, headers=None):
+    """Retrieves the page, returns None if the server replied 304 Not Modified to a conditional request
+    (headers), the response itself is kept in thread_data.response. Failed requests are retried
+    according to retry_policy, FetchError is raised when it gives up"""
 
     # this function should never be called if no_cache is specified
     assert not args.cache_only
 
+    with timings.measure('fetch'):
+        return retrieve(link, headers)
+
+def retrieve(link, headers):
     start_time = time.time()
-    if args.no_tor:
-        print('Directly retrieving ' + link)
-        live_url = urllib2.urlopen(link)#, timeout=300)
-        res = live_url.read()
-    else:
-        for i in range(1,numtries+1):
-            try:
-                print 'TOR Retrieving', link, 'attempt', i, 'of', numtries
-                res = session.get(link).text # need timeout=300 here but it does not work really
-            except:
-                time.sleep(3)
-                res = ''
+    for attempt in range(args.retries):
+        thread_data.response = None
+        try:
+            if args.no_tor:
+                print('Directly retrieving ' + link)
+                if direct_governor:
+                    direct_governor.wait()
+                thread_data.response = direct_session.get(link, headers=headers, timeout=(args.connect_timeout, args.read_timeout))
             else:
-                break
+                print 'TOR Retrieving', link, 'attempt', attempt + 1, 'of', args.retries
+                thread_data.tor = tor_pool.acquire()
+                thread_data.tor.wait()
+                request_start = time.time()
+                thread_data.response = thread_data.tor.session().get(link, headers=headers) # need timeout=300 here but it does not work really
+                thread_data.tor.circuit.add_request(time.time() - request_start, len(thread_data.response.content))
+            error = retry_policy.classify(response=thread_data.response)
+        except Exception as e:
+            error = retry_policy.classify(exc=e)
+            print 'Request', link, 'failed:', error, e
+
+        if error is None or error == 'captcha': # captcha is handled by the caller with a new identity
+            break
+        report_outcome('failure')
+        if attempt + 1 == args.retries or not retry_policy.spend(error):
+            print 'Failed to retrieve', link, 'after', time.time() - start_time, 's'
+            raise FetchError(link, error)
+        time.sleep(retry_policy.delay(attempt))
 
     elapsed_time = time.time() - start_time
-    if res:
-        print 'Page', link, ' retrieved at %s' % datetime.datetime.now(), 'in', elapsed_time, 's'
-    else:
-        print 'Failed to retrieve', link, 'after', elapsed_time, 's'
+    if thread_data.response.status_code == 304:
+        print 'Page', link, 'not modified, checked in', elapsed_time, 's'
+        return None
+    print 'Page', link, ' retrieved at %s' % datetime.datetime.now(), 'in', elapsed_time, 's'
+
+    return thread_data.response.text
+
+slim_page_mark = '<!-- slim page'
+center_re = re.compile(r'center:\s*\[')
+latlon_re = re.compile(r'center:\s*\[\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*\]')
+
+def extract_latlon(page):
+    """Returns (lat, lon) of the center of the map found in the raw page, None if there is no center"""
+    m = latlon_re.search(page)
+    return (float(m.group(1)), float(m.group(2))) if m else None
+
+def find_center_script(soup):
+    """Returns the script of the page setting the center of the map, None if there is no such script"""
+    for script in soup.findAll('script'):
+        if center_re.search(script.text):
+            return script
+    return None
+
+def slim_page(page, link):
+    """Cuts the house page down to the fragments read by the extractors, keeping their ancestors,
+    and prepends the address and fetch time. Pages without the data (captcha, errors) are returned as is"""
+    with timings.measure('slim'):
+        soup = BeautifulSoup(page, args.parser)
+    if soup.find('div', { 'class' : 'fr' }) is None:
+        return page
+    keep = soup.findAll('span', { 'class' : 'float-left loc_name_ohl width650 word-wrap-break-word' }) + \
+        soup.findAll('div', { 'class' : 'fr' }) + soup.findAll('div', { 'class' : 'numbered' })
+    center_script = find_center_script(soup)
+    if center_script is not None:
+        keep.append(center_script)
+    kept = set(id(tag) for tag in keep)
+    path = set(id(parent) for tag in keep for parent in tag.parents)
+
+    def prune(tag):
+        for child in list(tag.children):
+            if id(child) in path:
+                prune(child)
+            elif id(child) not in kept:
+                child.extract()
+    prune(soup)
+    return u'%s of %s fetched %s -->\n%s' % (slim_page_mark, link, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), unicode(soup))
+
+def urlopen_house(link,id,headers=None):
+    #fetch html data on a house, None if not modified since the cached copy
+
+    res = get_content(link, headers)
+    if res is None:
+        return res
+    if args.originals_folder and page_store.has(id) and classify_page(res) != 'valid' and cached_page_valid(id):
+        return res # captcha or error page, the valid cached copy is kept
+    if args.originals_folder:
+        if args.slim_cache:
+            res = slim_page(res, link)
+        if page_history and page_store.has(id) and not page_history.has(id) and cache_db.page_status(id) == 'valid':
+            page_history.add(id, page_store.read(id), page_store.fetched(id)) # the version cached before --history
+        location, size = page_store.write(id, res.encode('utf-8'))  #writing in utf-8 causes exceptions.UnicodeDecodeError
+        print 'Page', link, 'saved in', location, 'size=', size
+        if cache_quota:
+            cache_quota.add(size)
 
     return res
 
-def urlopen_house(link,id):
-    #fetch html data on a house
+class FetchError(Exception):
+    """The page could not be retrieved, kind is the classification of the last error"""
+
+    def __init__(self, link, kind):
+        Exception.__init__(self, '%s: %s' % (kind, link))
+        self.link = link
+        self.kind = kind
+
+class RetryPolicy(object):
+    """Classifies failed requests and spaces their retries with exponential backoff and jitter.
+    The number of retries in the run is limited by the budget, failures beyond it are not retried"""
+
+    def __init__(self, base, cap, budget):
+        self.base = base
+        self.cap = cap
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.errors = {}
+
+    def classify(self, exc=None, response=None):
+        """Returns kind of the error (timeout, refused, reset, connection, http5xx, captcha, other),
+        None for a good response"""
+        if exc is not None:
+            if isinstance(exc, (socket.timeout, requests.exceptions.Timeout, requesocks.exceptions.Timeout)):
+                return 'timeout'
+            reason = getattr(exc, 'errno', None)
+            message = str(exc).lower()
+            if reason == errno.ECONNREFUSED or 'refused' in message:
+                return 'refused'
+            if reason == errno.ECONNRESET or 'reset' in message:
+                return 'reset'
+            if isinstance(exc, (socket.error, requests.exceptions.ConnectionError, requesocks.exceptions.ConnectionError)):
+                return 'connection'
+            return 'other'
+        if response.status_code >= 500:
+            return 'http5xx'
+        if 'request_limiter_captcha' in response.text:
+            return 'captcha'
+        return None
+
+    def delay(self, attempt, base=None):
+        """Seconds to wait before the retry number attempt: half of the backoff is random"""
+        backoff = min(self.cap, (base or self.base) * 2 ** attempt)
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def spend(self, kind):
+        """Takes one retry from the budget, False if the budget is exhausted"""
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+            if self.budget <= 0:
+                return False
+            self.budget -= 1
+            if self.budget == 0:
+                print 'Retry budget exhausted, failed requests will not be retried any more'
+            return True
 
-    res = get_content(link)
-    if args.originals_folder:
-        f = open(args.originals_folder + id + ".html","wb")
-        f.write(res.encode('utf-8'))  #writing in utf-8 causes exceptions.UnicodeDecodeError
-        f.close()
-        print 'Page', link, 'saved in', args.originals_folder + id + '.html size=', os.path.getsize(args.originals_folder + id + ".html")
+    def stats(self):
+        return 'retries left %d, errors: ' % self.budget + ', '.join('%s %d' % kv for kv in sorted(self.errors.items()))
 
-    return res
+deferred_houses = [] # house_ids which could not be retrieved, process_houses retries them at the end
+deferred_lock = threading.Lock()
+
+def defer_house(house_id):
+    with deferred_lock:
+        deferred_houses.append(house_id)
+
+def take_deferred_houses():
+    with deferred_lock:
+        houses_ids = deferred_houses[:]
+        del deferred_houses[:]
+    return houses_ids
+
+class CacheDB(object):
+    """Bookkeeping of the originals folder, kept in cache.sqlite next to the pages"""
+
+    def __init__(self, fname):
+        self.lock = threading.Lock()
+        self.created = not os.path.exists(fname)
+        self.conn = sqlite3.connect(fname, check_same_thread=False)
+        self.conn.execute('create table if not exists house_state(house_id text primary key, lastupdate text, list_lastupdate text, fetched real, etag text, last_modified text, failures integer default 0)')
+        self.add_missing_columns('house_state', [('failures', 'integer default 0'), ('removed', 'text'), ('list_seen', 'real')])
+        # manifest of the cached pages, status is the classify_page result
+        self.conn.execute('create table if not exists pages(house_id text primary key, fetched real, size integer, hash text, status text)')
+        self.conn.execute('create index if not exists pages_status on pages(status)')
+        self.add_missing_columns('pages', [('accessed', 'real')])
+        self.conn.execute('create table if not exists meta(key text primary key, value text)')
+        self.conn.commit()
+
+    def add_missing_columns(self, table, columns):
+        """Upgrades a table created by an older version of the script"""
+        existing = [ row[1] for row in self.conn.execute('pragma table_info(' + table + ')') ]
+        for name, decl in columns:
+            if name not in existing:
+                self.conn.execute('alter table ' + table + ' add column ' + name + ' ' + decl)
+
+    def house_state(self, house_id):
+        """Returns dict with the state of the house, None for unknown house"""
+        with self.lock:
+            cur = self.conn.execute('select * from house_state where house_id = ?', (house_id,))
+            row = cur.fetchone()
+        return dict(zip([ d[0] for d in cur.description ], row)) if row else None
+
+    def house_states(self):
+        """Returns states of all known houses, dict by house_id"""
+        with self.lock:
+            cur = self.conn.execute('select * from house_state')
+            names = [ d[0] for d in cur.description ]
+            return dict((row[0], dict(zip(names, row))) for row in cur)
+
+    def add_failure(self, house_id):
+        with self.lock:
+            self.conn.execute('insert or ignore into house_state(house_id) values (?)', (house_id,))
+            self.conn.execute('update house_state set failures = coalesce(failures, 0) + 1 where house_id = ?', (house_id,))
+            self.conn.commit()
+
+    def manifest_complete(self):
+        """True if every cached page is recorded in the manifest"""
+        with self.lock:
+            return self.conn.execute("select value from meta where key = 'manifest_complete'").fetchone() is not None
+
+    def set_manifest_complete(self):
+        with self.lock:
+            self.conn.execute("insert or replace into meta values ('manifest_complete', ?)", (time.strftime('%Y-%m-%d %H:%M:%S'),))
+            self.conn.commit()
+
+    def page_status(self, house_id):
+        with self.lock:
+            row = self.conn.execute('select status from pages where house_id = ?', (house_id,)).fetchone()
+        return row[0] if row else None
+
+    def record_page(self, house_id, fetched, page, status):
+        self.record_page_digest(house_id, fetched, len(page), hashlib.md5(page).hexdigest(), status)
+
+    def record_page_digest(self, house_id, fetched, size, digest, status, commit=True):
+        with self.lock:
+            self.conn.execute('insert or replace into pages(house_id, fetched, size, hash, status, accessed) values (?, ?, ?, ?, ?, ?)',
+                              (house_id, fetched, size, digest, status, time.time()))
+            if commit:
+                self.conn.commit()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def touch_page(self, house_id, commit=True):
+        with self.lock:
+            self.conn.execute('update pages set accessed = ? where house_id = ?', (time.time(), house_id))
+            if commit:
+                self.conn.commit()
+
+    def eviction_candidates(self, valid=False):
+        """Returns (house_id, fetch time, status, md5) of the pages without valid data, of all the pages
+        if valid, least recently used first"""
+        with self.lock:
+            return self.conn.execute("select house_id, fetched, status, hash from pages" + ("" if valid else " where status != 'valid'") +
+                                     " order by coalesce(accessed, fetched)").fetchall()
+
+    def remove_page(self, house_id):
+        with self.lock:
+            self.conn.execute('delete from pages where house_id = ?', (house_id,))
+            self.conn.commit()
+
+    def house_ids_with_status(self, status):
+        with self.lock:
+            return [ row[0] for row in self.conn.execute('select house_id from pages where status = ? order by house_id', (status,)) ]
+
+    def pending(self, houses_ids):
+        """Returns the houses without a valid cached page, keeping the order"""
+        valid = set(self.house_ids_with_status('valid'))
+        return [ house_id for house_id in houses_ids if house_id not in valid ]
+
+    def set_house_state(self, house_id, **values):
+        with self.lock:
+            self.conn.execute('insert or ignore into house_state(house_id) values (?)', (house_id,))
+            self.conn.execute('update house_state set ' + ', '.join(k + ' = ?' for k in values) + ' where house_id = ?',
+                              values.values() + [house_id])
+            self.conn.commit()
+
+def lastupdate_date(text):
+    """Returns date part (dd.mm.yyyy) of a last update string, None if there is no date"""
+    mtch = re.search(r'\d{2}\.\d{2}\.\d{4}', text or '')
+    return mtch.group(0) if mtch else None
+
+def cache_is_stale(house_id):
+    """Checks if --incremental has to revalidate the cached page of the house"""
+    state = cache_db.house_state(house_id) or {}
+    fetched = state.get('fetched') or page_store.fetched(house_id)
+    if (state.get('list_lastupdate') and (state.get('list_seen') or 0) > fetched and
+        lastupdate_date(state['list_lastupdate']) == lastupdate_date(state.get('lastupdate'))):
+        return False # the list of the buildings seen after the fetch reports the same last update as the cached page
+    return time.time() - fetched > args.max_age * 86400
+
+def conditional_headers(house_id):
+    state = cache_db.house_state(house_id) or {}
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    return headers
+
+def mk_direct_session():
+    """Creates the session shared by all direct requests, it keeps the connections
+    to the site alive between the requests, one per download worker"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class RateGovernor(object):
+    """Request rate of a tor circuit (or of the direct connection): additive increase
+    after every good page, multiplicative decrease after captcha, 502 or time out"""
+
+    def __init__(self, name):
+        self.name = name
+        self.rate = args.rate
+        self.next_slot = 0 # time when the next request may be sent
+        self.lock = threading.Lock()
+        self.outcomes = dict(ok=0, captcha=0, badgateway=0, timeout=0, failure=0)
+
+    def wait(self):
+        """Sleeps until the next request slot, the slots are 1/rate seconds apart"""
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def report(self, outcome):
+        with self.lock:
+            self.outcomes[outcome] += 1
+            if outcome == 'ok':
+                self.rate = min(args.max_rate, self.rate + args.rate_increase)
+            else:
+                self.rate = max(args.min_rate, self.rate * args.rate_decrease)
+                self.next_slot = max(self.next_slot, time.time() + 1.0 / self.rate)
+                print 'Request rate of', self.name, 'reduced to %.3f/s after' % self.rate, outcome
 
-def change_proxy():
-    with Controller.from_port(port = 9151) as controller:
-            controller.authenticate(password="password")
+    def reset(self):
+        """Starts again from the initial rate, the slot already delayed and the outcome counts are kept"""
+        with self.lock:
+            self.rate = args.rate
+
+    def stats(self):
+        return '%s: rate %.3f/s, ' % (self.name, self.rate) + ', '.join('%s %d' % kv for kv in sorted(self.outcomes.items()))
+
+def report_outcome(outcome, check_health=True):
+    """Passes the outcome of the last request of the current thread to its rate governor
+    and to the statistics of the tor circuit"""
+    if args.no_tor:
+        if args.aimd:
+            direct_governor.report(outcome)
+    elif getattr(thread_data, 'tor', None):
+        if args.aimd:
+            thread_data.tor.governor.report(outcome)
+        thread_data.tor.circuit.add_outcome(outcome)
+        if check_health:
+            thread_data.tor.check_health()
+
+class CircuitStats(object):
+    """Statistics of a tor circuit, i.e. of a tor instance between two identity changes"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.latency = 0.0 # total, seconds
+        self.bytes = 0
+        self.outcomes = {}
+
+    def add_request(self, latency, size):
+        with self.lock:
+            self.requests += 1
+            self.latency += latency
+            self.bytes += size
+
+    def add_outcome(self, outcome):
+        with self.lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def avg_latency(self):
+        return self.latency / self.requests if self.requests else 0.0
+
+    def captcha_rate(self):
+        return float(self.outcomes.get('captcha', 0)) / self.requests if self.requests else 0.0
+
+    def degradation(self):
+        """Returns the reason to replace the circuit, None while it is healthy"""
+        if self.requests < args.min_circuit_requests:
+            return None
+        if self.avg_latency() > args.max_latency:
+            return 'average latency %.1fs' % self.avg_latency()
+        if self.captcha_rate() > args.max_captcha_rate:
+            return 'captcha rate %.2f' % self.captcha_rate()
+        return None
+
+    def stats(self):
+        return '%d requests in %ds, %.1f kB, average latency %.2fs, captcha rate %.2f, failures %d' % (
+            self.requests, time.time() - self.started, self.bytes / 1024.0, self.avg_latency(),
+            self.captcha_rate(), self.outcomes.get('failure', 0))
+
+class TorInstance(object):
+    """A local tor daemon: socks port for the requests, control port for the identity changes"""
+
+    def __init__(self, socks_port, ctl_port):
+        self.socks_port = socks_port
+        self.ctl_port = ctl_port
+        self.name = '%d:%d' % (socks_port, ctl_port)
+        self.lock = threading.Lock()     # only one worker at a time may ask for a new identity
+        self.local = threading.local()   # sessions are not shared between download workers
+        self.last_newnym = 0             # time of the last NEWNYM, to avoid rotating once per waiting worker
+        self.paused_until = 0            # the instance is not used until then after a captcha
+        self.governor = RateGovernor('tor ' + self.name) if args.aimd else None
+        self.controller = None           # kept open for the whole run
+        self.circuit = CircuitStats()
+        self.circuits = []               # statistics of the replaced circuits
+
+    def available_at(self):
+        return max(self.paused_until, self.governor.next_slot if self.governor else 0)
+
+    def wait(self):
+        """Sleeps while the instance is paused and until the rate governor allows the next request"""
+        while True:
+            remaining = self.paused_until - time.time() # sleep() of a negative time raises IOError
+            if remaining <= 0:
+                break
+            time.sleep(remaining)
+        if self.governor:
+            self.governor.wait()
+
+    def session(self):
+        if getattr(self.local, 'session', None) is None:
+            proxy = 'socks5://127.0.0.1:%d' % self.socks_port
+            self.local.session = requesocks.session()
+            self.local.session.proxies = {'http': proxy, 'https': proxy}
+        return self.local.session
+
+    def connect_controller(self):
+        """Returns authenticated connection to the control port, reconnects if it was lost"""
+        if self.controller is None or not self.controller.is_alive():
+            if self.controller is not None:
+                self.controller.close()
+            self.controller = Controller.from_port(port = self.ctl_port)
+            self.controller.authenticate(password=args.torctl_password)
+        return self.controller
+
+    def change_identity(self, requested_at=None, pause=0, reset_rate=False):
+        """Asks tor for a new identity and keeps the instance idle for pause seconds.
+        requested_at is the time the captcha was received, if the identity was changed
+        after that by another worker the request is ignored. reset_rate starts the new
+        circuit from --rate, otherwise it keeps the rate cut after the captcha"""
+        with self.lock:
+            if requested_at is not None and self.last_newnym > requested_at:
+                return
+            try:
+                controller = self.connect_controller()
+            except Exception:
+                self.controller = None
+                controller = self.connect_controller()
+            if not controller.is_newnym_available():
+                # tor silently ignores NEWNYM sent too soon after the previous one
+                wait = controller.get_newnym_wait()
+                print 'Tor', self.name, 'can change identity in %.1fs, waiting' % wait
+                time.sleep(wait)
             controller.signal(Signal.NEWNYM)
+            self.last_newnym = time.time()
+            self.paused_until = self.last_newnym + pause
+            print 'Tor', self.name, 'circuit replaced:', self.circuit.stats()
+            self.circuits.append(self.circuit)
+            self.circuit = CircuitStats()
+            if reset_rate and self.governor:
+                self.governor.reset()
+
+    def check_health(self):
+        """Replaces the circuit proactively when it became slow or flagged by the site"""
+        circuit = self.circuit
+        reason = circuit.degradation()
+        if reason:
+            print 'Tor', self.name, 'circuit degraded:', reason
+            self.change_identity(circuit.started, reset_rate=True) # the rate was tuned for the degraded exit
+
+    def stats(self):
+        """Returns description of the current circuit and the summary of the replaced ones"""
+        circuits = self.circuits + [self.circuit]
+        requests = sum(c.requests for c in circuits)
+        return 'tor %s: %d circuits, %d requests, %.1f kB, average latency %.2fs; current circuit: %s' % (
+            self.name, len(circuits), requests, sum(c.bytes for c in circuits) / 1024.0,
+            sum(c.latency for c in circuits) / requests if requests else 0.0, self.circuit.stats())
+
+    def close(self):
+        if self.controller is not None:
+            self.controller.close()
+            self.controller = None
+
+class TorPool(object):
+    """Spreads the requests across several tor instances round robin,
+    skipping the instances paused after a captcha"""
+
+    def __init__(self, instances):
+        self.instances = instances
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def acquire(self):
+        """Returns the instance which can take a request first, the caller has to wait() for it"""
+        with self.lock:
+            count = len(self.instances)
+            candidates = [ self.instances[(self.next + n) % count] for n in range(count) ]
+            tor = min(candidates, key=lambda t: t.available_at()) # first of the equals keeps round robin order
+            self.next = (self.instances.index(tor) + 1) % count
+        return tor
+
+def change_proxy(requested_at=None, pause=0):
+    """Changes identity of the tor instance used by the last request of the current thread"""
+    tor = getattr(thread_data, 'tor', None) or tor_pool.instances[0]
+    tor.change_identity(requested_at, pause)
 
 def extract_value(tr):
     #extract value for general attributes
@@ -202,15 +933,12 @@ def extract_subvalue(tr,num):
 def check_size(link):
 
     res = get_content(link)
-    soup = BeautifulSoup(''.join(res), args.parser)
-    captcha = check_captcha(soup)
 
-    while captcha == True:
+    while check_captcha(res):
         res = get_content(link)
-        soup = BeautifulSoup(''.join(res), args.parser)
-        captcha = check_captcha(soup)
         change_proxy()
 
+    soup = BeautifulSoup(''.join(res), args.parser)
     divs = soup.findAll('div', { 'class' : 'clearfix' })
     # TODO: check if this is a right page
     table = divs[1].find('table', { 'class' : 'col_list' })
@@ -219,6 +947,7 @@ def check_size(link):
     return size
 
 def get_house_list(link):
+    """Returns ids of the buildings in the list and the number of buildings reported by the site"""
     size = check_size(link)
     if size == 0: size = check_size(link)
 
@@ -227,25 +956,110 @@ def get_house_list(link):
     houses_ids = []
     for page in range(1,pages+1):
         res = get_content(link + '&page=' + str(page) + '&limit=10000')
-        soup = BeautifulSoup(''.join(res), args.parser)
-        captcha = check_captcha(soup)
 
-        while captcha == True:
+        while check_captcha(res):
             if args.no_tor:
                 print "Captcha received: the limit of connections was likely exceeded, quitting"
                 sys.exit(-1)
             res = get_content(link + '&page=' + str(page) + '&limit=10000')
-            soup = BeautifulSoup(''.join(res), args.parser)
-            captcha = check_captcha(soup)
             change_proxy()
 
+        soup = BeautifulSoup(''.join(res), args.parser)
         tds = soup.findAll('td')
         for td in tds:
             if td.find('a') is not None:
                 if td.find('a').has_attr('href') and 'myhouse' in td.find('a')['href']:
                     house_id = td.find('a')['href'].split('/')[4]
                     houses_ids.append(house_id)
-
+                    if args.incremental and td.parent is not None:
+                        # keep the last update date if the list shows it, --incremental skips unchanged houses
+                        list_lastupdate = lastupdate_date(td.parent.text)
+                        if list_lastupdate:
+                            cache_db.set_house_state(house_id, list_lastupdate=list_lastupdate, list_seen=time.time())
+
+    return houses_ids, int(size)
+
+# cached list of the buildings: header, then sorted house ids as little endian uint32
+house_list_header = struct.Struct('<4sBQdII') # magic, version, tid, fetch time, count reported by the site, number of ids
+
+def house_list_file_name(tid):
+    return args.originals_folder + dirsep + 'house_ids-' + str(tid) + '.bin'
+
+def write_house_list(fname, tid, houses_ids, reported, fetched=None):
+    ids = array.array('I', sorted(set(int(house_id) for house_id in houses_ids)))
+    if sys.byteorder == 'big':
+        ids.byteswap()
+    f = open(fname + '.tmp', 'wb')
+    f.write(house_list_header.pack('RGKL', 1, int(tid), fetched or time.time(), reported, len(ids)))
+    f.write(ids.tostring())
+    f.close()
+    os.rename(fname + '.tmp', fname)
+
+def read_house_list(fname):
+    """Returns house ids, fetch time and the count reported by the site"""
+    f = open(fname, 'rb')
+    magic, version, tid, fetched, reported, count = house_list_header.unpack(f.read(house_list_header.size))
+    if magic != 'RGKL' or version != 1:
+        raise ValueError('%s is not a list of the buildings' % fname)
+    ids = array.array('I')
+    ids.fromstring(f.read(count * ids.itemsize))
+    f.close()
+    if sys.byteorder == 'big':
+        ids.byteswap()
+    return [ str(house_id) for house_id in ids ], fetched, reported
+
+def diff_house_lists(previous_ids, houses_ids):
+    """Returns buildings added to the list, removed from it and unchanged"""
+    previous, current = set(previous_ids), set(houses_ids)
+    added = [ house_id for house_id in houses_ids if house_id not in previous ]
+    removed = [ house_id for house_id in previous_ids if house_id not in current ]
+    unchanged = [ house_id for house_id in houses_ids if house_id in previous ]
+    return added, removed, unchanged
+
+def removed_file_name():
+    """The tombstones of the removed buildings go next to the output, to the originals folder if there is no output file"""
+    if args.outputformat == 'pg' or args.extractor == 'none':
+        return args.originals_folder + 'removed.csv'
+    return os.path.splitext(args.output_name)[0] + '-removed.csv'
+
+def record_removed(tid, removed, added):
+    """Appends buildings which disappeared from the list to the removed file, keeps the date in cache.sqlite"""
+    date = time.strftime('%Y-%m-%d')
+    if removed:
+        f_removed = open(removed_file_name(), 'ab')
+        csvwriter = csv.writer(f_removed)
+        for house_id in removed:
+            csvwriter.writerow([house_id, tid, date])
+        f_removed.close()
+    if cache_db:
+        for house_id in removed:
+            cache_db.set_house_state(house_id, removed=date)
+        for house_id in added:
+            if (cache_db.house_state(house_id) or {}).get('removed'):
+                cache_db.set_house_state(house_id, removed=None) # back in the list
+
+def load_house_list(tid):
+    """Returns ids of the buildings of the region from the cached list, None if the list has to be retrieved"""
+    fname = house_list_file_name(tid)
+    legacy_fname = args.originals_folder + dirsep + 'house_ids-' + str(tid) + '.pickle'
+    if not os.path.isfile(fname) and os.path.isfile(legacy_fname):
+        print 'Converting', legacy_fname, 'to', fname
+        f_house_ids = open(legacy_fname, 'rb')
+        houses_ids = pickle.load(f_house_ids)
+        f_house_ids.close()
+        write_house_list(fname, tid, houses_ids, len(houses_ids), os.path.getmtime(legacy_fname))
+        out_of_the_way(legacy_fname)
+    if not os.path.isfile(fname):
+        return None
+
+    houses_ids, fetched, reported = read_house_list(fname)
+    age = (time.time() - fetched) / 86400
+    print 'Loaded', len(houses_ids), 'cached house_ids from', fname, '(%.1f days old, %d reported by the site)' % (age, reported)
+    if args.cache_only:
+        return houses_ids
+    if args.reload_list or (args.list_ttl is not None and age > args.list_ttl):
+        print 'Cached list of the buildings is stale, reloading'
+        return None
     return houses_ids
 
 def get_data_links(id):
@@ -259,50 +1073,697 @@ def get_data_links(id):
 
     return regs
 
-def check_captcha(soup):
-    captcha = soup.find('form', { 'name' : 'request_limiter_captcha'})
-    if captcha != None or u'Каптча' in soup.text or 'captcha' in str(soup):
-        return True
+# byte patterns of the page statuses, checked on the raw page in this order
+page_patterns = (
+    ('timeout', re.compile('Time-out')),
+    ('badgateway', re.compile('502 Bad Gateway')),
+    ('maintenance', re.compile(re.escape(u'Ð¢ÐµÑÐ½Ð¸ÑÐµÑÐºÐ¸Ðµ ÑÐ°Ð±Ð¾ÑÑ'.encode('utf-8')))),
+    ('error', re.compile(re.escape(u'Реформа ЖКХ Ошибка'.encode('utf-8')))),
+    ('captcha', re.compile('captcha|' + re.escape(u'Каптча'.encode('utf-8')))), # request_limiter_captcha form as well
+)
+captcha_re = page_patterns[-1][1]
+blank_re = re.compile(r'\s*$')
+# the plain UTF-8 maintenance banner only counts in the title or h1 of a short page, house pages
+# may mention it in menus and scripts
+maintenance_banner_re = re.compile(r'<(?:title|h1)[^>]*>\s*' + re.escape(u'Технические работы'.encode('utf-8')))
+maintenance_page_size = 8192
+
+def page_bytes(page):
+    return page.encode('utf-8') if isinstance(page, unicode) else page
+
+def check_captcha(page):
+    """True if the raw page is a captcha"""
+    return captcha_re.search(page_bytes(page)) is not None
+
+def classify_page(page):
+    """Returns status of the raw house page without parsing it: valid, empty, timeout, badgateway,
+    maintenance, error or captcha"""
+    page = page_bytes(page)
+    if blank_re.match(page):
+        return 'empty'
+    for status, pattern in page_patterns:
+        if pattern.search(page):
+            return status
+        if status == 'maintenance' and len(page) < maintenance_page_size and maintenance_banner_re.search(page):
+            return status
+    return 'valid'
+
+def parse_lxml(page):
+    """Returns the page parsed by lxml, None for an empty page"""
+    if isinstance(page, str):
+        page = page.decode('utf-8', 'replace')
+    if not page.strip():
+        return None
+    return lxml.html.document_fromstring(page)
+
+cache_suffixes = { 'none': '.html', 'gzip': '.html.gz', 'zstd': '.html.zst' }
+
+def mk_cache_file_name(house_id, compress=None):
+    return args.originals_folder + '/' + house_id + cache_suffixes[compress or args.compress]
+
+def find_cache_file(house_id):
+    """Returns name of the cached page in any of the supported formats, None if there is no such page"""
+    for compress in [args.compress] + [ c for c in sorted(cache_suffixes) if c != args.compress ]:
+        cache_fname = mk_cache_file_name(house_id, compress)
+        if os.path.isfile(cache_fname):
+            return cache_fname
+    return None
+
+def cache_file_house_id(cache_fname):
+    """Returns house_id of a cached page file name, None for other files"""
+    mtch = re.search(r'(\d{7})\.html(\.gz|\.zst)?$', cache_fname)
+    return mtch.group(1) if mtch else None
+
+def read_cache_file(cache_fname):
+    """Returns the cached page (utf-8 encoded) uncompressing it if needed"""
+    if cache_fname.endswith('.gz'):
+        f = gzip.open(cache_fname, 'rb')
+    else:
+        f = open(cache_fname, 'rb')
+    data = f.read()
+    f.close()
+    if cache_fname.endswith('.zst'):
+        if zstandard is None:
+            print 'zstandard module is required to read', cache_fname
+            sys.exit(-1)
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+def write_cache_file(house_id, data):
+    """Saves the page (utf-8 encoded) compressed as requested by --compress,
+    copies of the page in the other formats are removed. Returns the file name"""
+    cache_fname = mk_cache_file_name(house_id)
+    tmp_fname = cache_fname + '.tmp'
+    if args.compress == 'gzip':
+        f = gzip.open(tmp_fname, 'wb')
     else:
-        return False
+        f = open(tmp_fname, 'wb')
+        if args.compress == 'zstd':
+            data = zstandard.ZstdCompressor(level=10).compress(data)
+    f.write(data)
+    f.close()
+    os.rename(tmp_fname, cache_fname) # a run killed in the middle of writing leaves no truncated page behind
+    for compress in cache_suffixes:
+        if compress != args.compress and os.path.isfile(mk_cache_file_name(house_id, compress)):
+            os.remove(mk_cache_file_name(house_id, compress))
+    return cache_fname
+
+def remove_cache_files(house_id):
+    for compress in cache_suffixes:
+        cache_fname = mk_cache_file_name(house_id, compress)
+        if os.path.isfile(cache_fname):
+            os.remove(cache_fname)
+
+class FileStore(object):
+    """Page store keeping every page in its own file <house_id>.html[.gz|.zst] in the originals folder"""
+
+    def has(self, house_id):
+        return find_cache_file(house_id) is not None
+
+    def location(self, house_id):
+        return find_cache_file(house_id) or mk_cache_file_name(house_id)
+
+    def fetched(self, house_id):
+        return os.path.getmtime(find_cache_file(house_id))
+
+    def fetched_all(self):
+        """Returns fetch times of all the pages, dict by house_id"""
+        return dict((house_id, os.path.getmtime(fname)) for house_id, fname in self.files())
+
+    def read(self, house_id):
+        return read_cache_file(find_cache_file(house_id))
+
+    def write(self, house_id, data, fetched=None):
+        """Saves the page, returns its location and the stored size"""
+        cache_fname = write_cache_file(house_id, data)
+        if fetched:
+            os.utime(cache_fname, (fetched, fetched))
+        return cache_fname, os.path.getsize(cache_fname)
+
+    def remove(self, house_id):
+        remove_cache_files(house_id)
+
+    def stored_size(self, house_id):
+        return sum(os.path.getsize(mk_cache_file_name(house_id, compress)) for compress in cache_suffixes
+                   if os.path.isfile(mk_cache_file_name(house_id, compress)))
+
+    def disk_usage(self):
+        return sum(os.path.getsize(fname) for fname in glob.glob(args.originals_folder + '/*.html*'))
+
+    def cleanup(self):
+        """Removes leftovers of interrupted writes and copies of the pages older than the copy in use,
+        returns the freed bytes"""
+        freed = 0
+        for fname in glob.glob(args.originals_folder + '/*.html*.tmp'):
+            if time.time() - os.path.getmtime(fname) > 3600: # not being written right now
+                freed += os.path.getsize(fname)
+                os.remove(fname)
+        for house_id, fname in self.files():
+            for compress in cache_suffixes:
+                copy_fname = mk_cache_file_name(house_id, compress)
+                if copy_fname != fname and os.path.isfile(copy_fname) and os.path.getmtime(copy_fname) <= os.path.getmtime(fname):
+                    freed += os.path.getsize(copy_fname)
+                    os.remove(copy_fname)
+        return freed
+
+    def files(self):
+        """Yields (house_id, file name) of the cached pages, each house once"""
+        seen = set() # the page may be cached in several formats
+        for fname in sorted(glob.glob(args.originals_folder + '/*.html*')):
+            house_id = cache_file_house_id(fname)
+            if house_id and house_id not in seen:
+                seen.add(house_id)
+                yield house_id, find_cache_file(house_id)
+
+    def house_ids(self):
+        return [ house_id for house_id, fname in self.files() ]
+
+    def scan(self):
+        """Yields (house_id, page) of all the pages"""
+        for house_id, fname in self.files():
+            yield house_id, read_cache_file(fname)
+
+    def scan_order(self, houses_ids):
+        return list(houses_ids)
+
+    def locations(self):
+        """Returns (house_id, location, fetch time) of all the pages, location is understood by read_location"""
+        return [ (house_id, fname, os.path.getmtime(fname)) for house_id, fname in self.files() ]
+
+    def read_location(self, location):
+        return read_cache_file(location)
+
+    def quarantine(self, house_id, folder):
+        """Moves the page to the folder"""
+        shutil.move(find_cache_file(house_id), os.path.join(folder, os.path.basename(find_cache_file(house_id))))
+        remove_cache_files(house_id)
+
+    def close(self):
+        pass
+
+pack_name_re = re.compile(r'pages-(\d+)-(\d+)\.pack$')
+
+class PackStore(object):
+    """Page store appending pages to large pack files pack/pages-<shard>-<seq>.pack, a house goes to
+    shard house_id % --pack_shards. Index pack/index.sqlite maps house_id to (pack, offset, length,
+    fetch time, codec). Every record starts with a header (magic, house_id, fetch time, length, codec),
+    so the index can be rebuilt from the packs. Replaced and removed pages stay in the packs until
+    they are compacted"""
+
+    magic = 'RGKP'
+    header = struct.Struct('<4sQdIB')
+    codecs = { 'none': 0, 'gzip': 1, 'zstd': 2 } # gzip pages are stored as raw zlib streams
+
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        self.lock = threading.Lock()
+        self.appending = {} # shard -> open pack file
+        self.conn = sqlite3.connect(os.path.join(folder, 'index.sqlite'), check_same_thread=False)
+        self.conn.execute('create table if not exists pages(house_id text primary key, pack text, offset integer, length integer, fetched real, codec integer)')
+        self.conn.execute('create index if not exists pages_pack on pages(pack, offset)')
+        self.conn.commit()
+
+    def entry(self, house_id):
+        with self.lock:
+            return self.conn.execute('select pack, offset, length, fetched, codec from pages where house_id = ?', (house_id,)).fetchone()
+
+    def has(self, house_id):
+        return self.entry(house_id) is not None
+
+    def location(self, house_id):
+        entry = self.entry(house_id)
+        return '%s@%d' % (os.path.join(self.folder, entry[0]), entry[1]) if entry else os.path.join(self.folder, house_id)
+
+    def fetched(self, house_id):
+        return self.entry(house_id)[3]
+
+    def fetched_all(self):
+        with self.lock:
+            return dict(self.conn.execute('select house_id, fetched from pages').fetchall())
+
+    def decode(self, data, codec):
+        if codec == self.codecs['gzip']:
+            return zlib.decompress(data)
+        elif codec == self.codecs['zstd']:
+            if zstandard is None:
+                print 'zstandard module is required to read zstd compressed pages'
+                sys.exit(-1)
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        return data
 
-def mk_cache_file_name(house_id):
-    return args.originals_folder + '/' + house_id + ".html"
+    def read_at(self, pack, offset, length, codec):
+        f = open(os.path.join(self.folder, pack), 'rb')
+        f.seek(offset)
+        data = f.read(length)
+        f.close()
+        return self.decode(data, codec)
+
+    def read(self, house_id):
+        with self.lock: # the pack may be removed by compact() otherwise
+            pack, offset, length, fetched, codec = self.conn.execute('select pack, offset, length, fetched, codec from pages where house_id = ?', (house_id,)).fetchone()
+            f = open(os.path.join(self.folder, pack), 'rb')
+        f.seek(offset)
+        data = f.read(length)
+        f.close()
+        return self.decode(data, codec)
+
+    def packs(self):
+        """Returns {shard: [(seq, file name)]} of the pack files, sorted by seq"""
+        packs = {}
+        for fname in glob.glob(os.path.join(self.folder, 'pages-*.pack')):
+            m = pack_name_re.match(os.path.basename(fname))
+            if m:
+                packs.setdefault(int(m.group(1)), []).append((int(m.group(2)), fname))
+        for shard_packs in packs.values():
+            shard_packs.sort()
+        return packs
+
+    def pack_file(self, shard, fresh=False):
+        """Returns open pack file of the shard, starts a new pack when the current one is full or fresh is set"""
+        f = self.appending.get(shard)
+        if f is not None and not fresh and f.tell() < args.pack_size * 1024 * 1024:
+            return f
+        if f is not None:
+            f.close()
+        packs = self.packs().get(shard)
+        seq = packs[-1][0] if packs else 0
+        if packs and (fresh or os.path.getsize(packs[-1][1]) >= args.pack_size * 1024 * 1024):
+            seq += 1
+        f = open(os.path.join(self.folder, 'pages-%02d-%04d.pack' % (shard, seq)), 'ab')
+        f.seek(0, 2)
+        self.appending[shard] = f
+        return f
+
+    def write(self, house_id, data, fetched=None):
+        """Appends the page compressed as requested by --compress, returns its location and the stored size"""
+        codec = self.codecs[args.compress]
+        if args.compress == 'gzip':
+            data = zlib.compress(data, 6)
+        elif args.compress == 'zstd':
+            data = zstandard.ZstdCompressor(level=10).compress(data)
+        with self.lock:
+            location = self.append(house_id, data, fetched or time.time(), codec)
+            self.conn.commit()
+        return location, len(data)
+
+    def append(self, house_id, data, fetched, codec):
+        """Appends the record and indexes it, the caller holds the lock and commits"""
+        f = self.pack_file(int(house_id) % args.pack_shards)
+        f.write(self.header.pack(self.magic, int(house_id), fetched, len(data), codec))
+        offset = f.tell()
+        f.write(data)
+        f.flush()
+        self.conn.execute('insert or replace into pages values (?, ?, ?, ?, ?, ?)', (house_id, os.path.basename(f.name), offset, len(data), fetched, codec))
+        return '%s@%d' % (f.name, offset)
+
+    def remove(self, house_id):
+        with self.lock:
+            self.conn.execute('delete from pages where house_id = ?', (house_id,))
+            self.conn.commit()
+
+    def stored_size(self, house_id):
+        entry = self.entry(house_id)
+        return self.header.size + entry[2] if entry else 0
+
+    def disk_usage(self):
+        return sum(os.path.getsize(fname) for fname in glob.glob(os.path.join(self.folder, '*.pack')))
+
+    def cleanup(self, min_garbage=0.25):
+        """Compacts the packs with more than min_garbage share of replaced and removed pages: their live
+        records are appended to the current packs and the packs are removed. Returns the freed bytes"""
+        freed = 0
+        with self.lock:
+            live = dict(self.conn.execute('select pack, sum(length) + count(*) * ? from pages group by pack', (self.header.size,)).fetchall())
+            packs = self.packs()
+            for shard in sorted(packs):
+                for seq, fname in packs[shard]:
+                    pack, size = os.path.basename(fname), os.path.getsize(fname)
+                    if size == 0 or size - live.get(pack, 0) <= min_garbage * size:
+                        continue
+                    if fname == packs[shard][-1][1]:
+                        self.pack_file(shard, fresh=True) # stop appending to it
+                    entries = self.conn.execute('select house_id, offset, length, fetched, codec from pages where pack = ? order by offset', (pack,)).fetchall()
+                    f = open(fname, 'rb')
+                    for house_id, offset, length, fetched, codec in entries:
+                        f.seek(offset)
+                        self.append(house_id, f.read(length), fetched, codec)
+                    f.close()
+                    self.conn.commit()
+                    os.remove(fname)
+                    freed += size - live.get(pack, 0)
+        return freed
+
+    def house_ids(self):
+        with self.lock:
+            return [ row[0] for row in self.conn.execute('select house_id from pages order by house_id') ]
+
+    def locations(self):
+        with self.lock:
+            return [ (house_id, (pack, offset, length, codec), fetched) for house_id, pack, offset, length, fetched, codec
+                     in self.conn.execute('select house_id, pack, offset, length, fetched, codec from pages order by pack, offset') ]
+
+    def read_location(self, location):
+        return self.read_at(*location)
+
+    def quarantine(self, house_id, folder):
+        """Writes the page to <house_id>.html in the folder and removes it from the index"""
+        f = open(os.path.join(folder, house_id + '.html'), 'wb')
+        f.write(self.read(house_id))
+        f.close()
+        self.remove(house_id)
+
+    def scan_order(self, houses_ids):
+        """Returns the houses ordered as their pages are in the packs, the houses without a page last"""
+        with self.lock:
+            position = dict((row[0], i) for i, row in enumerate(self.conn.execute('select house_id from pages order by pack, offset')))
+        return sorted(houses_ids, key=lambda house_id: position.get(str(house_id), len(position)))
+
+    def scan(self):
+        """Yields (house_id, page) of all the pages reading the packs sequentially"""
+        with self.lock:
+            entries = self.conn.execute('select house_id, pack, offset, length, codec from pages order by pack, offset').fetchall()
+        f = None
+        for house_id, pack, offset, length, codec in entries:
+            if f is None or f.name != os.path.join(self.folder, pack):
+                if f is not None:
+                    f.close()
+                f = open(os.path.join(self.folder, pack), 'rb')
+            f.seek(offset)
+            yield house_id, self.decode(f.read(length), codec)
+        if f is not None:
+            f.close()
+
+    def close(self):
+        with self.lock:
+            for f in self.appending.values():
+                f.close()
+            self.appending = {}
+            self.conn.close()
+
+class PageHistory(object):
+    """Versions of the house pages in history.sqlite. The first version of a house and every checkpoint-th one
+    are stored whole, the others as forward deltas against the previous version: copied ranges of its tokens
+    (the page split after each '>') and inserted text. All zlib compressed"""
+
+    checkpoint = 10
+
+    def __init__(self, fname):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(fname, check_same_thread=False)
+        self.conn.execute('create table if not exists versions(house_id text, seq integer, fetched real, hash text, full integer, data blob, primary key(house_id, seq))')
+        self.conn.commit()
+
+    @staticmethod
+    def tokens(page):
+        parts = page.split('>')
+        return [ part + '>' for part in parts[:-1] ] + [ parts[-1] ]
+
+    @staticmethod
+    def delta(old_tokens, new_tokens):
+        ops = []
+        for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_tokens, new_tokens).get_opcodes():
+            if tag == 'equal':
+                ops.append((i1, i2))
+            elif j2 > j1:
+                ops.append(''.join(new_tokens[j1:j2]))
+        return ops
+
+    @staticmethod
+    def patch(old_tokens, ops):
+        return ''.join(''.join(old_tokens[op[0]:op[1]]) if isinstance(op, tuple) else op for op in ops)
+
+    def read_version(self, house_id, seq):
+        """Rebuilds the version from the closest checkpoint, the caller holds the lock"""
+        rows = self.conn.execute('select seq, full, data from versions where house_id = ? and seq <= ? and seq >= '
+                                 '(select max(seq) from versions where house_id = ? and seq <= ? and full = 1) order by seq',
+                                 (house_id, seq, house_id, seq)).fetchall()
+        page = None
+        for seq, full, data in rows:
+            data = zlib.decompress(data)
+            page = data if full else self.patch(self.tokens(page), marshal.loads(data))
+        return page
+
+    def add(self, house_id, page, fetched):
+        """Appends the page as the latest version of the house unless it is the same as the latest one"""
+        digest = hashlib.md5(page).hexdigest()
+        with self.lock:
+            last = self.conn.execute('select seq, hash from versions where house_id = ? order by seq desc limit 1', (house_id,)).fetchone()
+            if last and last[1] == digest:
+                return
+            seq = last[0] + 1 if last else 0
+            if seq % self.checkpoint == 0:
+                full, data = 1, page
+            else:
+                full, data = 0, marshal.dumps(self.delta(self.tokens(self.read_version(house_id, last[0])), self.tokens(page)))
+            self.conn.execute('insert into versions values (?, ?, ?, ?, ?, ?)', (house_id, seq, fetched, digest, full, buffer(zlib.compress(data, 6))))
+            self.conn.commit()
+
+    def has(self, house_id):
+        with self.lock:
+            return self.conn.execute('select 1 from versions where house_id = ? limit 1', (house_id,)).fetchone() is not None
+
+    def read_as_of(self, house_id, ts):
+        """Returns the version in effect at ts and its fetch time, None if the house had no version then"""
+        with self.lock:
+            row = self.conn.execute('select seq, fetched from versions where house_id = ? and fetched <= ? order by seq desc limit 1', (house_id, ts)).fetchone()
+            return (self.read_version(house_id, row[0]), row[1]) if row else None
+
+    def house_ids(self):
+        with self.lock:
+            return [ row[0] for row in self.conn.execute('select distinct house_id from versions order by house_id') ]
+
+    def copies(self):
+        """Returns the set of (house_id, md5) of all versions"""
+        with self.lock:
+            return set(self.conn.execute('select house_id, hash from versions'))
+
+    def read_latest(self, house_id):
+        """Returns the latest version of the page, None if the house has no version"""
+        version = self.read_as_of(house_id, time.time())
+        return version[0] if version else None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def mk_page_store():
+    if args.store == 'pack':
+        return PackStore(args.originals_folder + 'pack')
+    return FileStore()
+
+def migrate_to_pack():
+    """Moves the pages from the files of the originals folder into the pack store"""
+    files = FileStore()
+    count = 0
+    for house_id, fname in files.files():
+        page_store.write(house_id, read_cache_file(fname), os.path.getmtime(fname))
+        files.remove(house_id) # the page is in the pack and in the index already
+        count += 1
+        if count % 1000 == 0:
+            print count, 'pages moved'
+    print count, 'pages moved to', page_store.folder
+
+def cached_page_valid(house_id):
+    """True if the cached page of the house has valid data, by the manifest or by classifying the page"""
+    status = cache_db.page_status(house_id)
+    return (status or classify_page(page_store.read(house_id))) == 'valid'
 
 def invalidate_cache(house_id):
-    cache_fname = mk_cache_file_name(house_id)
-    if os.path.isfile(cache_fname):
-        os.remove(cache_fname)
+    page_store.remove(house_id)
+    if cache_db:
+        cache_db.remove_page(house_id)
+
+def record_page(house_id, page, status, src):
+    """Keeps the classification of the cached page in the manifest"""
+    if src == 'web' or cache_db.page_status(house_id) != status:
+        if isinstance(page, unicode):
+            page = page.encode('utf-8') # as it is stored
+        cache_db.record_page(house_id, time.time() if src == 'web' else page_store.fetched(house_id), page, status)
+    else:
+        cache_db.touch_page(house_id, commit=False) # for the LRU eviction, committed in batches
+
+cache_low_water = 0.9 # during the download the originals folder is freed down to this share of --cache_max_size
+
+def maintain_cache(target=None):
+    """Frees space in the originals folder: leftovers and replaced copies, then the pages without valid data
+    older than --cache_max_age and, least recently used first, over target (--cache_max_size by default).
+    Valid pages are evicted only if the same page is kept in the history. Returns True if the cache fits the quota"""
+    if target is None:
+        target = args.cache_max_size
+    if not cache_db.manifest_complete():
+        print 'Manifest is not complete, pages missing from it are kept (see --rebuild_manifest)'
+    freed = page_store.cleanup()
+    usage = page_store.disk_usage()
+    evicted = 0
+    copies = page_history.copies() if page_history else set()
+    for house_id, fetched, status, digest in cache_db.eviction_candidates(valid=bool(copies)):
+        if status == 'valid' and (house_id, digest) not in copies:
+            continue # the only valid copy
+        expired = args.cache_max_age is not None and time.time() - fetched > args.cache_max_age * 86400
+        if expired or (target is not None and usage > target):
+            size = page_store.stored_size(house_id)
+            invalidate_cache(house_id)
+            usage -= size
+            freed += size
+            evicted += 1
+    if evicted and args.store == 'pack':
+        page_store.cleanup() # evicted pages stay in the packs until compacted
+    usage = page_store.disk_usage()
+    print 'Cache maintenance:', evicted, 'pages evicted, %.1f MB freed, %.1f MB used' % (freed / 1048576.0, usage / 1048576.0), \
+        '' if args.cache_max_size is None else 'of %.1f MB' % (args.cache_max_size / 1048576.0)
+    return args.cache_max_size is None or usage <= args.cache_max_size
+
+class CacheQuota(object):
+    """Counts the bytes written to the originals folder, runs maintain_cache when they exceed --cache_max_size"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.usage = page_store.disk_usage()
+
+    def add(self, size):
+        with self.lock:
+            self.usage += size
+            if self.usage <= args.cache_max_size:
+                return
+            if not maintain_cache(int(args.cache_max_size * cache_low_water)): # not again after every page
+                print 'The originals folder does not fit --cache_max_size without evicting valid pages missing from the history (see --history), quitting...'
+                sys.exit(4)
+            self.usage = page_store.disk_usage()
+
+def rebuild_manifest():
+    """Classifies all cached pages and records them in the manifest"""
+    counts = {}
+    for house_id, page in page_store.scan():
+        status = classify_page(page)
+        cache_db.record_page(house_id, page_store.fetched(house_id), page, status)
+        counts[status] = counts.get(status, 0) + 1
+    cache_db.set_manifest_complete()
+    print 'Manifest rebuilt:', ', '.join('%s %d' % kv for kv in sorted(counts.items())) or 'no pages'
+
+def fsck_page(task):
+    """Classifies a cached page in a worker process of fsck, returns (house_id, status, size, md5)"""
+    house_id, location = task
+    try:
+        page = page_store.read_location(location)
+    except Exception as e:
+        return house_id, 'unreadable', 0, None
+    return house_id, classify_page(page), len(page), hashlib.md5(page).hexdigest()
+
+def fsck():
+    """Classifies all cached pages in parallel, records them in the manifest, writes fsck.csv and refetch.txt,
+    moves the pages which are not valid to the quarantine folder if requested"""
+    locations = page_store.locations()
+    fetch_times = dict((house_id, fetched) for house_id, location, fetched in locations)
+    jobs = args.jobs or multiprocessing.cpu_count()
+    print 'Checking', len(locations), 'pages in', jobs, 'processes'
+    sys.stdout.flush() # otherwise the workers print it again
+    pool = multiprocessing.Pool(jobs)
+    counts = {}
+    bad = []
+    f_report = open('fsck.csv', 'wb')
+    csvwriter = csv.writer(f_report)
+    csvwriter.writerow(['house_id', 'status', 'size', 'location'])
+    for i, (house_id, status, size, digest) in enumerate(pool.imap_unordered(fsck_page, [ (house_id, location) for house_id, location, fetched in locations ], 64)):
+        counts[status] = counts.get(status, 0) + 1
+        csvwriter.writerow([house_id, status, size, page_store.location(house_id)])
+        if status == 'valid':
+            cache_db.record_page_digest(house_id, fetch_times[house_id], size, digest, status, commit=False)
+        else:
+            bad.append(house_id)
+            if digest:
+                cache_db.record_page_digest(house_id, fetch_times[house_id], size, digest, status, commit=False)
+        if (i + 1) % 10000 == 0:
+            cache_db.commit()
+            print i + 1, 'pages checked'
+    pool.close()
+    pool.join()
+    cache_db.commit()
+    cache_db.set_manifest_complete()
+    f_report.close()
+
+    f_refetch = open('refetch.txt', 'wb')
+    for house_id in sorted(bad, key=int):
+        f_refetch.write(house_id + '\n')
+    f_refetch.close()
+    if args.quarantine and bad:
+        folder = args.originals_folder + dirsep + 'quarantine'
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        for house_id in bad:
+            try:
+                page_store.quarantine(house_id, folder)
+            except (IOError, zlib.error):
+                page_store.remove(house_id) # unreadable
+            cache_db.remove_page(house_id)
+        print len(bad), 'pages moved to', folder
+    print 'Fsck:', ', '.join('%s %d' % kv for kv in sorted(counts.items())) or 'no pages'
+    print 'Report written to fsck.csv,', len(bad), 'buildings to refetch listed in refetch.txt (see --houseids_file)'
 
 def load_bldg_page(link,house_id):
     """Loads HTML page for a spceified building either from the web or from cache
-    returns the page, False on failure, and the source of the page (web, file, None for failure)"""
-
-    if args.originals_folder:
-        cache_fname = mk_cache_file_name(house_id)
-        bldg_link = link + 'view/' + house_id
-        if not os.path.isfile(cache_fname):
-            if args.cache_only:
-                print 'Cache file', cache_fname, 'does not exist, skipping...'
+    returns the page, False on failure, and the source of the page (web, file, history, None for failure)"""
+
+    bldg_link = link + 'view/' + house_id
+    if args.as_of:
+        version = page_history.read_as_of(house_id, as_of)
+        if version is None:
+            print house_id, ': no version of the page as of', args.as_of
+            return False, None
+        res, thread_data.page_fetched = version
+        src = 'history'
+        print house_id, ': loaded version fetched', datetime.datetime.fromtimestamp(thread_data.page_fetched), 'from the history'
+    elif args.originals_folder:
+        if not page_store.has(house_id):
+            if args.cache_only and page_history and page_history.has(house_id):
+                res = page_history.read_latest(house_id) # evicted from the cache
+                src = 'history'
+                print house_id, ': loaded the latest version from the history'
+            elif args.cache_only:
+                print 'Cache file', page_store.location(house_id), 'does not exist, skipping...'
                 res = False
                 src = None
             else:
                 src = 'web'
                 try:
                     res = urlopen_house(bldg_link, house_id)
-                except:
+                except FetchError as e:
+                    print "Error retrieving", bldg_link, ": ", e.kind, ', deferred'
+                    defer_house(house_id)
+                    res = False
+                except Exception: # not SystemExit, the cache quota stops the run
                     print "Error retrieving", bldg_link, ": ", sys.exc_info()[0]
                     f_errors.write(bldg_link + '\n')
                     res = False
+        elif args.incremental and cache_is_stale(house_id):
+            src = 'web'
+            try:
+                res = urlopen_house(bldg_link, house_id, conditional_headers(house_id))
+            except Exception:
+                print "Error revalidating", bldg_link, ": ", sys.exc_info()[0], ', using cached page'
+                res = None
+            status = classify_page(res) if res is not None else None
+            if status not in (None, 'valid') and cached_page_valid(house_id):
+                print house_id, ': revalidation returned', status, 'page, loaded from cache file', page_store.location(house_id)
+                if status in ('captcha', 'timeout', 'badgateway'):
+                    report_outcome(status)
+                src = 'file'
+                res = page_store.read(house_id)
+            elif res is None:
+                src = 'file'
+                res = page_store.read(house_id)
+                cache_db.set_house_state(house_id, fetched=time.time())
+                print house_id, ': not modified, loaded from cache file', page_store.location(house_id)
         else:
             src = 'file'
-            res = open(cache_fname,'rb').read()
-            print house_id, ': loaded from cache file', cache_fname
+            res = page_store.read(house_id)
+            print house_id, ': loaded from cache file', page_store.location(house_id)
     else:
         try:
             src = 'web'
             res = urlopen_house(bldg_link, house_id)
-        except:
+        except Exception:
             f_errors.write(bldg_link + '\n')
             res = False
 
@@ -312,21 +1773,35 @@ def get_housedata(link,house_id,lvl1_name,lvl1_id,lvl2_name,lvl2_id):
     """Tries hard to retrieve the page content one way or another,
     then checks for errors, changes relay if needed, etc."""
 
-    if args.fast_check and os.path.exists(mk_cache_file_name(house_id)):
-        print house_id, 'in cache, checks skipped'
-        return True
+    if args.fast_check and cache_db:
+        status = cache_db.page_status(house_id)
+        if status == 'valid' or (status is None and not cache_db.manifest_complete() and page_store.has(house_id)):
+            print house_id, 'in cache, checks skipped'
+            return True
 
     captcha_count = 0
     while True:
         res, src = load_bldg_page(link,house_id)
+        captcha_time = time.time()
 
         if res == False:
             return False
+        if src == 'file' and args.full_pages and res.startswith(slim_page_mark):
+            print house_id, ': slim page in cache, requesting the full page'
+            invalidate_cache(house_id)
+            continue
 
-        soup = BeautifulSoup(''.join(res),args.parser)
-        f_ids.write(link + 'view/' + house_id + ',' + house_id + '\n')
+        with output_lock:
+            f_ids.write(link + 'view/' + house_id + ',' + house_id + '\n')
 
-        if len(soup) == 0:
+        status = classify_page(res) # only valid pages are parsed
+        if src == 'history':
+            if status != 'valid':
+                return False
+        elif cache_db and src:
+            record_page(house_id, res, status, src)
+
+        if status == 'empty':
             print house_id, ': 0 size html'
             if src == 'web':
                 return False
@@ -334,13 +1809,16 @@ def get_housedata(link,house_id,lvl1_name,lvl1_id,lvl2_name,lvl2_id):
                 invalidate_cache(house_id)
                 continue
 
-        if 'Time-out' in soup.text:
-            print house_id, ': Time out reported by server'
-            return False
-        if '502 Bad Gateway' in soup.text:
-            print house_id, ': Bad gateway'
+        if status in ('timeout', 'badgateway'):
+            print house_id, ': Time out reported by server' if status == 'timeout' else ': Bad gateway'
+            if src == 'web':
+                report_outcome(status)
+            elif not args.cache_only:
+                # the error page got into the cache, try to replace it
+                invalidate_cache(house_id)
+                continue
             return False
-        if u'Ð¢ÐµÑÐ½Ð¸ÑÐµÑÐºÐ¸Ðµ ÑÐ°Ð±Ð¾ÑÑ' in soup.text:
+        if status == 'maintenance':
             print house_id, ': maintenance'
             if src == 'web':
                 print 'The site is in the maintenance mode, quiting...'
@@ -352,7 +1830,7 @@ def get_housedata(link,house_id,lvl1_name,lvl1_id,lvl2_name,lvl2_id):
                     invalidate_cache(house_id)
                     continue
 
-        if u'Реформа ЖКХ Ошибка' in soup.text:
+        if status == 'error':
             if args.cache_only:
                 print house_id, ': unspecified error page in cache, skipping'
                 return False
@@ -362,7 +1840,7 @@ def get_housedata(link,house_id,lvl1_name,lvl1_id,lvl2_name,lvl2_id):
                 print 'You may have to remove cached page for building ', house_id
                 sys.exit(-1)
 
-        if check_captcha(soup):
+        if status == 'captcha':
             if args.cache_only:
                 print house_id, ': captcha page in cache, skipping'
                 return False
@@ -372,9 +1850,15 @@ def get_housedata(link,house_id,lvl1_name,lvl1_id,lvl2_name,lvl2_id):
             else:
                 invalidate_cache(house_id)
                 if src == 'web':
-                    print house_id, ': captcha received, invalidating cache, requesting new proxy, attempt #', captcha_count, 'sleep 60s'
-                    change_proxy()
-                    time.sleep( 60 )
+                    if args.aimd:
+                        print house_id, ': captcha received, invalidating cache, requesting new proxy, attempt #', captcha_count, 'tor', thread_data.tor.name
+                        report_outcome('captcha', False) # the governor slows the circuit down instead of a fixed pause
+                        change_proxy(captcha_time)
+                    else:
+                        report_outcome('captcha', False)
+                        pause = retry_policy.delay(captcha_count, base=60)
+                        print house_id, ': captcha received, invalidating cache, requesting new proxy, attempt #', captcha_count, 'tor', thread_data.tor.name, 'paused for %ds' % pause
+                        change_proxy(captcha_time, pause) # the other tor instances keep working meanwhile
                     captcha_count += 1
                 else:
                     print house_id, ': captcha in cached file, invalidating'
@@ -385,15 +1869,59 @@ def get_housedata(link,house_id,lvl1_name,lvl1_id,lvl2_name,lvl2_id):
                 continue
                 #return False # leave house_id unprocessed
 
+        with timings.measure('parse'):
+            if args.extractor == 'lxml':
+                doc = parse_lxml(res)
+            else:
+                soup = BeautifulSoup(''.join(res),args.parser)
+
+        if src == 'web':
+            report_outcome('ok')
+            if cache_db:
+                record_fetch(house_id, extract_lastupdate_lxml(doc) if args.extractor == 'lxml' else extract_lastupdate(soup))
+            if page_history:
+                page_history.add(house_id, res.encode('utf-8'), time.time())
+
         if args.extractor == 'original':
-            return parse_house_page_original(soup)
+            with output_lock, timings.measure('extract'):
+                return parse_house_page_original(soup,res,house_id)
         elif args.extractor == 'attrlist':
-            return parse_house_page_attrlist(soup)
+            with output_lock, timings.measure('extract'):
+                return parse_house_page_attrlist(soup,res,house_id)
+        elif args.extractor == 'lxml':
+            with output_lock, timings.measure('extract'):
+                return parse_house_page_lxml(doc,res,house_id)
         else:
             print house_id, ': data extraction skipped'
             return True
 
-def parse_house_page_original(soup):
+def extract_lastupdate(soup):
+    """Returns 'Последнее изменение анкеты' of the house page, None if the page has no such field"""
+    try:
+        lastupdate = soup.find('div', { 'class' : 'fr' }).findAll('table')[1].findAll('tr')[8].findAll('td')[1].text.strip()
+    except (AttributeError, IndexError):
+        return None
+    return ' '.join(lastupdate.replace('\n','').split())
+
+def record_fetch(house_id, lastupdate):
+    """Keeps fetch time, last update and validators of a page just retrieved from the site"""
+    state = cache_db.house_state(house_id) or {}
+    if lastupdate and lastupdate == state.get('lastupdate'):
+        print house_id, ': unchanged since', lastupdate.encode('utf-8')
+    cache_db.set_house_state(house_id, lastupdate=lastupdate, fetched=time.time(), failures=0,
+                             etag=thread_data.response.headers.get('ETag'),
+                             last_modified=thread_data.response.headers.get('Last-Modified'))
+
+def parse_house_page_original(soup,page,house_id):
+    write_house_row(extract_house_original(soup,page,house_id))
+    return True
+
+def write_house_row(row):
+    with timings.measure('write'):
+        csvwriter_housedata.writerow(dict((k, v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.items()))
+
+def extract_house_original(soup,page,house_id):
+    """Returns the output row of the original extractor"""
     address = soup.find('span', { 'class' : 'float-left loc_name_ohl width650 word-wrap-break-word' }).text.strip()
 
     #GENERAL
@@ -417,16 +1945,11 @@ def parse_house_page_original(soup):
     trs = table1.findAll('tr')
     #area = float(trs[2].findAll('td')[1].text.strip().replace(' ',''))  #gen1 Общая площадь
     #year = trs[6].findAll('td')[1].text.strip()                          #gen6 Год ввода в экспл
-    lastupdate = trs[8].findAll('td')[1].text.strip()                    #gen2 Последнее изменение анкеты
-    lastupdate = ' '.join(lastupdate.replace('\n','').split())
+    lastupdate = extract_lastupdate(soup) or ''                          #gen2 Последнее изменение анкеты
     servicedate_start = trs[10].findAll('td')[1].text.strip()            #gen3 Дата начала обслуживания дома
     servicedate_end = '' #trs[5].findAll('td')[1].text.strip()           #gen4 Плановая дата прекращения обслуживания дома
 
-    #TODO extract lat/long coords from script
-    if 'center' in soup.findAll('script')[11]:
-        lat,lon = soup.findAll('script')[11].text.split('\n')[3].split('[')[1].split(']')[0].split(',')
-    else:
-        lat,lon = soup.findAll('script')[12].text.split('\n')[3].split('[')[1].split(']')[0].split(',')
+    lat,lon = extract_latlon(page) or (None, None)
 
     #PASSPORT
     ##GENERAL
@@ -466,118 +1989,206 @@ def parse_house_page_original(soup):
     other = extract_value(trs[57 + trs_offset])                           #14 Элементы благоустройства
 
 
-    #write to output
-    csvwriter_housedata.writerow(dict(LAT=lat,
-                                      LON=lon,
-                                      HOUSE_ID=house_id,
-                                      ADDRESS=address.encode('utf-8'),
-                                      YEAR=year.encode('utf-8'),
-                                      LASTUPDATE=lastupdate.encode('utf-8'),
-                                      SERVICEDATE_START=servicedate_start.encode('utf-8'),
-                                      SERIE=serie.encode('utf-8'),
-                                      HOUSE_TYPE=house_type.encode('utf-8'),
-                                      CAPFOND=capfond.encode('utf-8'),
-                                      MGMT_COMPANY=mgmt_company.encode('utf-8'),
-                                      MGMT_COMPANY_LINK=mgmt_company_link.encode('utf-8'),
-                                      AVAR=avar.encode('utf-8'),
-                                      LEVELS_MAX=levels_max.encode('utf-8'),
-                                      LEVELS_MIN=levels_min.encode('utf-8'),
-                                      DOORS=doors.encode('utf-8'),
-                                      ROOM_COUNT=room_count.encode('utf-8'),
-                                      ROOM_COUNT_LIVE=room_count_live.encode('utf-8'),
-                                      ROOM_COUNT_NONLIVE=room_count_nonlive.encode('utf-8'),
-                                      AREA=area.encode('utf-8'),
-                                      AREA_LIVE=area_live.encode('utf-8'),
-                                      AREA_NONLIVE=area_nonlive.encode('utf-8'),
-                                      AREA_GEN=area_gen.encode('utf-8'),
-                                      AREA_LAND=area_land.encode('utf-8'),
-                                      AREA_PARK=area_park.encode('utf-8'),
-                                      #CADNO=cadno.encode('utf-8'),
-                                      ENERGY_CLASS=energy_class.encode('utf-8'),
-                                      BLAG_PLAYGROUND=blag_playground.encode('utf-8'),
-                                      BLAG_SPORT=blag_sport.encode('utf-8'),
-                                      BLAG_OTHER=blag_other.encode('utf-8'),
-                                      OTHER=other.encode('utf-8')))
+    return dict(LAT=lat,
+                LON=lon,
+                HOUSE_ID=house_id,
+                ADDRESS=address,
+                YEAR=year,
+                LASTUPDATE=lastupdate,
+                SERVICEDATE_START=servicedate_start,
+                SERIE=serie,
+                HOUSE_TYPE=house_type,
+                CAPFOND=capfond,
+                MGMT_COMPANY=mgmt_company,
+                MGMT_COMPANY_LINK=mgmt_company_link,
+                AVAR=avar,
+                LEVELS_MAX=levels_max,
+                LEVELS_MIN=levels_min,
+                DOORS=doors,
+                ROOM_COUNT=room_count,
+                ROOM_COUNT_LIVE=room_count_live,
+                ROOM_COUNT_NONLIVE=room_count_nonlive,
+                AREA=area,
+                AREA_LIVE=area_live,
+                AREA_NONLIVE=area_nonlive,
+                AREA_GEN=area_gen,
+                AREA_LAND=area_land,
+                AREA_PARK=area_park,
+                #CADNO=cadno,
+                ENERGY_CLASS=energy_class,
+                BLAG_PLAYGROUND=blag_playground,
+                BLAG_SPORT=blag_sport,
+                BLAG_OTHER=blag_other,
+                OTHER=other)
+
+if lxml is not None:
+    # XPath of the lxml extractor, the same elements as in extract_house_original
+    xp_address = lxml.etree.XPath('//span[normalize-space(@class) = "float-left loc_name_ohl width650 word-wrap-break-word"]')
+    xp_fr = lxml.etree.XPath('//div[contains(concat(" ", normalize-space(@class), " "), " fr ")]')
+    xp_numbered = lxml.etree.XPath('//div[contains(concat(" ", normalize-space(@class), " "), " numbered ")]')
+    xp_tables = lxml.etree.XPath('.//table')
+    xp_trs = lxml.etree.XPath('.//tr')
+    xp_tds = lxml.etree.XPath('.//td')
+    xp_links = lxml.etree.XPath('.//a')
+
+def lxml_value(tr):
+    return xp_tds(tr)[1].text_content().strip()
+
+def lxml_subvalue(tr, num):
+    return xp_trs(tr)[num].text_content().strip()
+
+def extract_lastupdate_lxml(doc):
+    """extract_lastupdate for the page parsed by lxml"""
+    try:
+        lastupdate = xp_tds(xp_trs(xp_tables(xp_fr(doc)[0])[1])[8])[1].text_content().strip()
+    except IndexError:
+        return None
+    return ' '.join(lastupdate.replace('\n','').split())
+
+def extract_house_lxml(doc,page,house_id):
+    """Returns the output row of the original extractor from the page parsed by lxml"""
+    address = xp_address(doc)[0].text_content().strip()
+
+    #GENERAL
+    tables = xp_tables(xp_fr(doc)[0])
+    td = xp_tds(xp_trs(tables[0])[0])[1]
+    mgmt_company = td.text_content().strip()
+    links = xp_links(td)
+    mgmt_company_link = ('http://www.reformagkh.ru' + links[0].get('href')).split('?')[0] if links else ''
+    trs = xp_trs(tables[1])
+    lastupdate = extract_lastupdate_lxml(doc) or ''
+    servicedate_start = lxml_value(trs[10])
+
+    lat,lon = extract_latlon(page) or (None, None)
+
+    #PASSPORT
+    trs = xp_trs(xp_numbered(doc)[0])
+    trs_offset = len(trs) - 58 if len(trs) > 58 else 0
+
+    return dict(LAT=lat,
+                LON=lon,
+                HOUSE_ID=house_id,
+                ADDRESS=address,
+                YEAR=lxml_value(trs[3]),
+                LASTUPDATE=lastupdate,
+                SERVICEDATE_START=servicedate_start,
+                SERIE=lxml_value(trs[5]),
+                HOUSE_TYPE=lxml_value(trs[7]),
+                CAPFOND=lxml_value(trs[9]),
+                MGMT_COMPANY=mgmt_company,
+                MGMT_COMPANY_LINK=mgmt_company_link,
+                AVAR=lxml_value(trs[11]),
+                LEVELS_MAX=lxml_subvalue(trs[12], 1),
+                LEVELS_MIN=lxml_subvalue(trs[12], 3),
+                DOORS=lxml_value(trs[18]),
+                ROOM_COUNT=lxml_value(trs[23]),
+                ROOM_COUNT_LIVE=lxml_value(trs[26]),
+                ROOM_COUNT_NONLIVE=lxml_value(trs[28]),
+                AREA=lxml_value(trs[31]).replace(' ',''),
+                AREA_LIVE=lxml_value(trs[34]).replace(' ',''),
+                AREA_NONLIVE=lxml_value(trs[36]).replace(' ',''),
+                AREA_GEN=lxml_value(trs[38]).replace(' ',''),
+                AREA_LAND=lxml_value(trs[41]).replace(' ',''),
+                AREA_PARK=lxml_value(trs[43]).replace(' ',''),
+                ENERGY_CLASS=lxml_value(trs[48 + trs_offset]),
+                BLAG_PLAYGROUND=lxml_value(trs[51 + trs_offset]),
+                BLAG_SPORT=lxml_value(trs[53 + trs_offset]),
+                BLAG_OTHER=lxml_value(trs[55 + trs_offset]),
+                OTHER=lxml_value(trs[57 + trs_offset]))
+
+extractor_verification = { 'pages': 0, 'differ': 0 }
+
+def parse_house_page_lxml(doc,page,house_id):
+    if not args.verify_extractor:
+        write_house_row(extract_house_lxml(doc,page,house_id))
+        return True
+
+    # the original extractor output is written, the lxml one is compared to it
+    expected = extract_house_original(BeautifulSoup(''.join(page),args.parser),page,house_id)
+    try:
+        row = extract_house_lxml(doc,page,house_id)
+    except Exception as e:
+        print house_id, ': lxml extractor failed:', repr(e)
+        row = {}
+    encoded = lambda v: v.encode('utf-8') if isinstance(v, unicode) else v
+    differ = [ k for k in fieldnames_data if k in expected and encoded(row.get(k)) != encoded(expected[k]) ]
+    extractor_verification['pages'] += 1
+    if differ:
+        extractor_verification['differ'] += 1
+        for k in differ:
+            print house_id, ': lxml extractor differs in', k, repr(row.get(k)), '!=', repr(expected[k])
+    write_house_row(expected)
     return True
 
 def write_house_attribute(result_set):
+    with timings.measure('write'):
+        write_house_attribute_untimed(result_set)
+
+def write_house_attribute_untimed(result_set):
     if args.outputformat == 'csv':
         csvwriter_housedata.writerow(result_set)
     elif args.outputformat == 'sqlite':
         result_set['ATTR_NAME'] = result_set['ATTR_NAME'].decode('utf-8') if result_set['ATTR_NAME'] else None
         result_set['FOUND_NAME'] = result_set['FOUND_NAME'].decode('utf-8') if result_set['FOUND_NAME'] else None
-        result_set['VALUE'] = result_set['VALUE'].decode('utf-8') if result_set['VALUE'] else None
+        if not isinstance(result_set['VALUE'], float): # lat and lon
+            result_set['VALUE'] = result_set['VALUE'].decode('utf-8') if result_set['VALUE'] else None
         sqcur.execute("insert into attrvals values (" + fieldnames_phld + ")", [ result_set[k] for k in fieldnames_data])
     else: # outputformat == 'pg'
-        psycopg2.extras.execute_values(pgcur, pgquery, [[result_set[k] for k in fieldnames_data]], template=None)
+        row = [ result_set[k] for k in fieldnames_data ]
+        if args.as_of:
+            row.append(datetime.datetime.fromtimestamp(thread_data.page_fetched)) # ts of the version, not of the run
+        psycopg2.extras.execute_values(pgcur, pgquery, [row], template=None)
 
-def parse_house_page_attrlist(soup):
+def parse_house_page_attrlist(soup,page,house_id):
     """Parses a house page using attrlist information"""
+    for result_set in extract_house_attrlist(soup,page,house_id):
+        write_house_attribute(result_set)
 
-    # lat lon extractions
-    latlon_re = r'center: \[(\d+\.\d+),\s*(\d+\.\d+)\],'
-    latlon_match = re.search(latlon_re, soup.findAll('script')[11].text)
-    if not latlon_match:
-        latlon_match = re.search(latlon_re, soup.findAll('script')[12].text)
-    if latlon_match:
-        lat,lon = latlon_match.group(1),latlon_match.group(2)
+    if args.outputformat in ('sqlite', 'pg'):
+        conn.commit()
+
+def extract_house_attrlist(soup,page,house_id):
+    """Returns the attributes of the house page found with the attrlist plan, lat and lon first"""
+
+    latlon = extract_latlon(page)
+    if latlon:
+        lat,lon = latlon
     else:
         lat,lon = 'Not Found','Not Found'
         print '\tlat,lon was not found'
 
-    write_house_attribute(dict(REGION=region_name,HOUSE_ID=house_id,ATTR_NAME='lat',FOUND_NAME='lat',ED_DIST=0,VALUE=lat))
-    write_house_attribute(dict(REGION=region_name,HOUSE_ID=house_id,ATTR_NAME='lon',FOUND_NAME='lon',ED_DIST=0,VALUE=lon))
+    result_sets = [ dict(REGION=region_name,HOUSE_ID=house_id,ATTR_NAME='lat',FOUND_NAME='lat',ED_DIST=0,VALUE=lat),
+                    dict(REGION=region_name,HOUSE_ID=house_id,ATTR_NAME='lon',FOUND_NAME='lon',ED_DIST=0,VALUE=lon) ]
 
-    # create output variable name from the section names
-    sect_attrs = ['section-rus', 'subsection-rus', 'attribute-rus', 'subattribute-rus', 'subsubattribute-rus']
-    cur_sect = dict.fromkeys(sect_attrs)
+    found = attrlist_matcher.match(soup)
+    for rule in attrlist_plan:
+        result_name = found[rule.name_selector]
 
-    for row in attrlist:
+        if result_name is not None:
+            found_attr_name = result_name.text.strip().encode('utf-8')
 
-        # update section attributes
-        for attr in sect_attrs:
-            if row[attr]:
-                cur_sect[attr] = row[attr]
-                for i in range(sect_attrs.index(attr)+1,len(sect_attrs)-1):
-                    cur_sect[sect_attrs[i]] = None
-            expected_attr_name = row[attr] or expected_attr_name # expected attr string is set to the last section name
+            # value extraction
+            result_value = found[rule.value_selector]
 
-        if row['Selector Code for Name']:
-            attr_name = '->'.join([ cur_sect[attr] for attr in sect_attrs if cur_sect[attr] ])
-            fixed_selector_code_name = re.sub('nth-child', 'nth-of-type', row['Selector Code for Name']) # this is needed because bs does not support nth-child
-            fixed_selector_code_value = re.sub('nth-child', 'nth-of-type', row['Selector Code for Value'])
-            #fixed_selector_code_name = row['Selector Code for Name']
-            #fixed_selector_code_value = row['Selector Code for Value']
-            #print attr_name, '==>', row['Selector Code for Name'], '==>', fixed_selector_code_name
-
-            result_name = soup.select(fixed_selector_code_name)
-
-            if result_name:
-                found_attr_name = result_name[0].text.strip().encode('utf-8')
-
-                # value extraction
-                result_value = soup.select(fixed_selector_code_value)
-
-                found_attr_value = result_value[0].text.strip().encode('utf-8') if result_value else 'not found'
-
-                result_set = dict(REGION=region_name,
-                                  HOUSE_ID=house_id,
-                                  ATTR_NAME=attr_name,
-                                  FOUND_NAME=found_attr_name,
-                                  ED_DIST=editdistance.eval(expected_attr_name,found_attr_name),
-                                  VALUE=found_attr_value)
-            else: # not found
-                result_set = dict(REGION=region_name,
-                                  HOUSE_ID=house_id,
-                                  ATTR_NAME=attr_name,
-                                  FOUND_NAME=None,
-                                  ED_DIST=None,
-                                  VALUE=None)
-
-            write_house_attribute(result_set)
-
-        if args.outputformat in ('sqlite', 'pg'):
-            conn.commit()
+            found_attr_value = result_value.text.strip().encode('utf-8') if result_value is not None else 'not found'
+
+            result_set = dict(REGION=region_name,
+                              HOUSE_ID=house_id,
+                              ATTR_NAME=rule.attr_name,
+                              FOUND_NAME=found_attr_name,
+                              ED_DIST=edit_distance.eval(rule.expected_name,found_attr_name),
+                              VALUE=found_attr_value)
+        else: # not found
+            result_set = dict(REGION=region_name,
+                              HOUSE_ID=house_id,
+                              ATTR_NAME=rule.attr_name,
+                              FOUND_NAME=None,
+                              ED_DIST=None,
+                              VALUE=None)
+
+        result_sets.append(result_set)
+
+    return result_sets
 
 def load_attrlist():
     """Loads the list of attributes and their id string from a CSV file."""
@@ -604,6 +2215,380 @@ def load_attrlist():
 
     return attrlist
 
+class EditDistanceMemo(object):
+    """Edit distance of the expected and found attribute names. The name pairs repeat from house to house,
+    so the distances are kept in a LRU memo of maxsize pairs"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.memo = OrderedDict()
+        self.exact = self.hits = self.misses = 0
+
+    def eval(self, expected, found):
+        if expected == found:
+            self.exact += 1
+            return 0
+        key = (expected, found)
+        with self.lock:
+            dist = self.memo.pop(key, None)
+            if dist is not None:
+                self.hits += 1
+                self.memo[key] = dist # most recently used
+                return dist
+        dist = editdistance.eval(expected, found)
+        with self.lock:
+            self.misses += 1
+            self.memo[key] = dist
+            if len(self.memo) > self.maxsize:
+                self.memo.popitem(last=False)
+        return dist
+
+    def stats(self):
+        lookups = self.exact + self.hits + self.misses
+        return 'lookups=%d exact=%d hits=%d misses=%d hit rate=%.1f%% memo=%d' % (
+            lookups, self.exact, self.hits, self.misses,
+            100.0 * (self.exact + self.hits) / lookups if lookups else 0, len(self.memo))
+
+edit_distance = EditDistanceMemo(65536)
+
+AttrRule = namedtuple('AttrRule', 'attr_name expected_name name_selector value_selector')
+
+def compile_selector(selector):
+    """Returns the selector compiled if BeautifulSoup matches with soupsieve"""
+    return soupsieve.compile(selector) if soupsieve else selector
+
+def select_first(soup, selector):
+    """Returns the first element matching the compiled selector, None if there is no such element"""
+    found = selector.select(soup, limit=1) if soupsieve else soup.select(selector)
+    return found[0] if found else None
+
+compound_re = re.compile(r'^(?:\*|([a-zA-Z][\w-]*))?((?:[.#][\w-]+)*)(?::nth-of-type\((\d+)\))?$')
+
+def parse_selector(selector):
+    """Splits a selector into steps (combinator, tag, id, classes, nth-of-type), ' ' is the descendant
+    combinator. Returns None if the selector uses something else than tags, classes, ids, nth-of-type, '>' and ' '"""
+    steps = []
+    combinator = ' '
+    for token in selector.replace('>', ' > ').split():
+        if token == '>':
+            if not steps or combinator == '>':
+                return None
+            combinator = '>'
+            continue
+        m = compound_re.match(token)
+        if m is None:
+            return None
+        tag_name, rest, nth = m.groups()
+        parts = re.findall(r'([.#])([\w-]+)', rest)
+        ids = [ v for k,v in parts if k == '#' ]
+        if len(ids) > 1:
+            return None
+        steps.append((combinator, tag_name, ids[0] if ids else None,
+                      frozenset(v for k,v in parts if k == '.'), int(nth) if nth else None))
+        combinator = ' '
+    if not steps or combinator == '>':
+        return None
+    return steps
+
+class SelectorMatcher(object):
+    """Matches all selectors of the extraction plan in one walk of the page. The selectors are kept
+    in a trie of their steps, so the shared prefixes (div.numbered > table > ...) are matched once.
+    Selectors it can not parse are matched with select_first"""
+
+    def __init__(self, selectors):
+        self.edges = [ {} ] # trie node: {step: next node}
+        self.index = [ {} ] # trie node: {(combinator, tag): [(step, next node)]}
+        self.ends = [ [] ] # trie node: selectors ending there
+        self.fallback = {}
+        self.selectors = []
+        for selector in selectors:
+            if selector in self.fallback or selector in self.selectors:
+                continue
+            steps = parse_selector(selector)
+            if steps is None:
+                self.fallback[selector] = compile_selector(selector)
+                continue
+            node = 0
+            for step in steps:
+                if step not in self.edges[node]:
+                    self.edges.append({})
+                    self.index.append({})
+                    self.ends.append([])
+                    self.edges[node][step] = len(self.edges) - 1
+                    self.index[node].setdefault((step[0], step[1]), []).append((step, len(self.edges) - 1))
+                node = self.edges[node][step]
+            self.ends[node].append(selector)
+            self.selectors.append(selector)
+
+    def advance(self, node, combinator, tag, nth, matched):
+        """Adds the trie nodes reached from node by tag to matched"""
+        index = self.index[node]
+        for key in ((combinator, tag.name), (combinator, None)):
+            for (_, tag_name, tag_id, classes, step_nth), next_node in index.get(key, ()):
+                if ((step_nth is None or step_nth == nth) and (tag_id is None or tag.get('id') == tag_id) and
+                    (not classes or classes.issubset(tag.get('class', ())))):
+                    matched.add(next_node)
+
+    def walk(self, element, parent_nodes, ancestor_nodes, found, left):
+        """Matches the children of element in document order, parent_nodes are the trie nodes matched
+        by element, ancestor_nodes the ones matched by element or its ancestors. Returns False when
+        all selectors were found"""
+        counts = {} # nth-of-type of the children
+        for child in element.children:
+            if not isinstance(child, bs4.Tag):
+                continue
+            nth = counts[child.name] = counts.get(child.name, 0) + 1
+            matched = set()
+            for node in parent_nodes:
+                self.advance(node, '>', child, nth, matched)
+            for node in ancestor_nodes:
+                self.advance(node, ' ', child, nth, matched)
+            for node in matched:
+                for selector in self.ends[node]:
+                    if found[selector] is None:
+                        found[selector] = child
+                        left[0] -= 1
+            if not left[0]:
+                return False
+            if child.contents and not self.walk(child, matched, ancestor_nodes | matched if matched else ancestor_nodes, found, left):
+                return False
+        return True
+
+    def match(self, soup):
+        """Returns {selector: first matching element or None} for all selectors"""
+        found = dict.fromkeys(self.selectors)
+        if self.selectors:
+            self.walk(soup, frozenset(), frozenset([0]), found, [len(self.selectors)])
+        for selector, compiled in self.fallback.iteritems():
+            found[selector] = select_first(soup, compiled)
+        return found
+
+def compile_attrlist(attrlist):
+    """Compiles the rows of the attribute list into the extraction plan: a tuple of AttrRule with
+    the output name built from the section names, the expected name and the selectors"""
+    sect_attrs = ['section-rus', 'subsection-rus', 'attribute-rus', 'subattribute-rus', 'subsubattribute-rus']
+    cur_sect = dict.fromkeys(sect_attrs)
+    expected_attr_name = None
+    plan = []
+    for row in attrlist:
+
+        # update section attributes
+        for attr in sect_attrs:
+            if row[attr]:
+                cur_sect[attr] = row[attr]
+                for i in range(sect_attrs.index(attr)+1,len(sect_attrs)-1):
+                    cur_sect[sect_attrs[i]] = None
+            expected_attr_name = row[attr] or expected_attr_name # expected attr string is set to the last section name
+
+        if row['Selector Code for Name']:
+            plan.append(AttrRule(attr_name='->'.join([ cur_sect[attr] for attr in sect_attrs if cur_sect[attr] ]),
+                                 expected_name=expected_attr_name,
+                                 name_selector=row['Selector Code for Name'].replace('nth-child', 'nth-of-type'), # bs does not support nth-child
+                                 value_selector=row['Selector Code for Value'].replace('nth-child', 'nth-of-type')))
+    return tuple(plan)
+
+def house_processed(house_id,res):
+    if res == False:
+        print 'Building data was not retrieved for id=', house_id
+        if cache_db and not args.cache_only:
+            cache_db.add_failure(house_id)
+
+def extract_page(task):
+    """Extracts the data of a cached page in a worker process of extract_houses. Returns (house_id, status,
+    size, md5, rows, parse time, extract time, error), rows is None for the pages which are not valid
+    and the ones the extractor failed on, error describes the failure. The page of the task is read from
+    the location unless it is given"""
+    house_id, location, page = task
+    try:
+        if page is None:
+            page = page_store.read_location(location)
+    except Exception as e:
+        return house_id, 'unreadable', 0, None, None, 0, 0, repr(e)
+    status = classify_page(page)
+    size, digest = len(page), hashlib.md5(page).hexdigest()
+    if status != 'valid':
+        return house_id, status, size, digest, None, 0, 0, None
+    try:
+        start = time.time()
+        if args.extractor == 'lxml':
+            doc = parse_lxml(page)
+        else:
+            soup = BeautifulSoup(page, args.parser)
+        parsed = time.time()
+        if args.extractor == 'original':
+            rows = [ extract_house_original(soup,page,house_id) ]
+        elif args.extractor == 'lxml':
+            rows = [ extract_house_lxml(doc,page,house_id) ]
+        else:
+            rows = extract_house_attrlist(soup,page,house_id)
+    except Exception as e: # a malformed page must not stop the run
+        return house_id, status, size, digest, None, 0, 0, '%s: %s' % (type(e).__name__, e)
+    return house_id, status, size, digest, rows, parsed - start, time.time() - parsed, None
+
+extraction = {} # the page locations and the worker pool of extract_houses, made once per run
+
+def extract_houses(houses_ids):
+    """Extracts the data of the cached pages of the houses in args.jobs processes, the rows are
+    written here in the order of houses_ids. Returns the number of processed house_ids"""
+    if not extraction:
+        extraction['locations'] = dict((house_id, (location, fetched)) for house_id, location, fetched in page_store.locations())
+        sys.stdout.flush() # otherwise the workers print it again
+        extraction['pool'] = multiprocessing.Pool(args.jobs)
+    locations = extraction['locations']
+    found = []
+    for house_id in houses_ids:
+        house_id = str(house_id)
+        f_ids.write(house_link + 'view/' + house_id + ',' + house_id + '\n')
+        if house_id in locations or (page_history and page_history.has(house_id)):
+            found.append(house_id)
+        else:
+            print 'Cache file', page_store.location(house_id), 'does not exist, skipping...'
+            house_processed(house_id, False)
+
+    def tasks():
+        # pages evicted from the cache are read from the history here, the others by the workers
+        for house_id in found:
+            if house_id in locations:
+                yield house_id, locations[house_id][0], None
+            else:
+                yield house_id, None, page_history.read_latest(house_id)
+
+    print 'Extracting', len(found), 'cached pages in', args.jobs, 'processes'
+    for i, (house_id, status, size, digest, rows, parse_time, extract_time, error) in enumerate(extraction['pool'].imap(extract_page, tasks(), 16), 1):
+        if digest and house_id in locations:
+            if cache_db.page_status(house_id) != status:
+                cache_db.record_page_digest(house_id, locations[house_id][1], size, digest, status, commit=False)
+            else:
+                cache_db.touch_page(house_id, commit=False)
+        if status == 'empty' and house_id in locations:
+            print house_id, ': 0 size html'
+            invalidate_cache(house_id)
+            del locations[house_id]
+        elif error:
+            print 'Error extracting house_id', house_id, ':', error
+        elif status != 'valid':
+            print house_id, ':', status, 'page in cache, skipping'
+        else:
+            timings.add('parse', parse_time)
+            start = time.time()
+            for row in rows:
+                if args.extractor == 'attrlist':
+                    write_house_attribute(row)
+                else:
+                    write_house_row(row)
+            timings.add('extract', extract_time + time.time() - start)
+        house_processed(house_id, rows is not None)
+        if i % 1000 == 0:
+            if args.outputformat in ('sqlite', 'pg'):
+                conn.commit()
+            cache_db.commit()
+            print i, 'pages extracted'
+    if args.outputformat in ('sqlite', 'pg'):
+        conn.commit()
+    cache_db.commit()
+    return len(found)
+
+def process_houses(houses,retry_deferred=True):
+    """Processes the list of (house_id, region) pairs, either one by one or
+    with args.workers download workers. Returns the number of processed house_ids"""
+
+    if parallel_extraction:
+        return extract_houses([ house_id for house_id, reg in houses ])
+
+    if args.workers == 1 or len(houses) < 2:
+        i = 0
+        for house_id, reg in houses:
+            i = i+1
+            print i, '\tProcessing house_id', house_id
+            res = get_housedata(house_link,str(house_id),reg[0],reg[3],reg[1],reg[4])
+            house_processed(house_id, res)
+            if cache_db and i % 1000 == 0:
+                cache_db.commit()
+        if cache_db:
+            cache_db.commit()
+        process_deferred(houses, retry_deferred)
+        return i
+
+    house_queue = Queue.Queue()
+    for i, (house_id, reg) in enumerate(houses, 1):
+        house_queue.put((i, house_id, reg))
+    stop = [] # SystemExit raised by a worker, the other workers finish their current house and quit
+
+    def worker():
+        while not stop:
+            try:
+                i, house_id, reg = house_queue.get_nowait()
+            except Queue.Empty:
+                return
+            print i, '\tProcessing house_id', house_id
+            try:
+                res = get_housedata(house_link,str(house_id),reg[0],reg[3],reg[1],reg[4])
+            except SystemExit as e:
+                stop.append(e)
+                return
+            except Exception:
+                print 'Error processing house_id', house_id, ': ', sys.exc_info()[0]
+                res = False
+            house_processed(house_id, res)
+
+    print 'Starting', args.workers, 'download workers'
+    workers = [ threading.Thread(target=worker, name='worker-%d' % n) for n in range(args.workers) ]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    for w in workers:
+        while w.is_alive():
+            w.join(1) # join with timeout keeps the main thread responsive to Ctrl-C
+    if cache_db:
+        cache_db.commit()
+    if stop:
+        raise stop[0]
+
+    process_deferred(houses, retry_deferred)
+    return len(houses) - house_queue.qsize()
+
+def process_deferred(houses,retry_deferred):
+    """Gives the houses deferred after failed requests one more chance"""
+    houses_ids = take_deferred_houses()
+    if not houses_ids:
+        return
+    if not retry_deferred:
+        print len(houses_ids), 'house_ids failed again:', ' '.join(houses_ids)
+        return
+    print 'Retrying', len(houses_ids), 'deferred house_ids'
+    regs = dict(houses)
+    process_houses([ (house_id, regs[house_id]) for house_id in houses_ids ], False)
+
+def schedule_houses(region_houses):
+    """Orders houses of several regions for --schedule staleness: never fetched houses first,
+    then the oldest cached pages, then the houses which failed less often. The regions are
+    interleaved, so that every region gets its share of the most valuable pages"""
+
+    states = cache_db.house_states() if cache_db else {}
+    cached = page_store.fetched_all()
+    keyed = []
+    for region_no, (reg, houses_ids) in enumerate(region_houses):
+        region_keys = []
+        for house_id in houses_ids:
+            state = states.get(house_id) or {}
+            if house_id in cached:
+                fetched = state.get('fetched') or cached[house_id]
+                key = (1, fetched, state.get('failures') or 0)
+            else:
+                key = (0, 0, state.get('failures') or 0)
+            region_keys.append((key, house_id))
+        region_keys.sort()
+        # rank within the region interleaves the regions inside of each tier (never fetched, cached)
+        ranks = {}
+        for key, house_id in region_keys:
+            rank = ranks[key[0]] = ranks.get(key[0], -1) + 1
+            keyed.append(((key[0], rank, region_no), house_id, reg))
+    keyed.sort(key=lambda k: k[0])
+
+    print len(keyed), 'house_ids scheduled,', sum(1 for k in keyed if k[0][0] == 0), 'of them never fetched'
+    return [ (house_id, reg) for key, house_id, reg in keyed ]
+
 def out_of_the_way(file_name):
     if os.path.isfile(file_name):
         bfile_name = file_name + '.{:%Y-%m-%dT%H.%M.%S}'.format(datetime.datetime.now())
@@ -611,38 +2596,75 @@ def out_of_the_way(file_name):
         shutil.move(file_name, bfile_name)
 
 if __name__ == '__main__':
-    if not args.no_tor:
-        print 'Establishing tor connection to socks5://127.0.0.1:9150...'
-        session = requesocks.session()
-        session.proxies = {'http':  'socks5://127.0.0.1:9150',
-                           'https': 'socks5://127.0.0.1:9150'}
-        try:
-            print 'Tor connection established, testing duckduckgo.com'
-            session.get('http://duckduckgo.com').text
-            print 'Connected to Tor network!'
-        except:
+    retry_policy = RetryPolicy(args.backoff, args.backoff_max, args.retry_budget)
+    direct_governor = None
+    if args.no_tor:
+        if not args.cache_only:
+            direct_session = mk_direct_session()
+            if args.aimd:
+                direct_governor = RateGovernor('direct connection')
+    else:
+        tor_instances = []
+        for socks_port, ctl_port in tor_endpoints:
+            print 'Establishing tor connection to socks5://127.0.0.1:%d...' % socks_port
+            tor = TorInstance(socks_port, ctl_port)
+            try:
+                print 'Tor connection established, testing duckduckgo.com'
+                tor.session().get('http://duckduckgo.com').text
+                print 'Connected to Tor network!'
+                tor_instances.append(tor)
+            except:
+                print 'Tor instance', tor.name, 'isn\'t running or not configured properly'
+        if not tor_instances:
             print('Tor isn\'t running or not configured properly')
             sys.exit(1)
+        tor_pool = TorPool(tor_instances)
 
     tid = args.id #2280999
-    lvl1_link = 'http://www.reformagkh.ru/myhouse?tid=' + tid #+ '&sort=alphabet&item=mkd'
-    house_link = 'http://www.reformagkh.ru/myhouse/profile/'
+    lvl1_link = args.site + '/myhouse?tid=' + tid #+ '&sort=alphabet&item=mkd'
+    house_link = args.site + '/myhouse/profile/'
     #house_id = 8625429
 
     region = namedtuple('reg', 'lvl1name lvl2name lvl3name lvl1tid lvl2tid lvl3tid')
 
+    cache_db = CacheDB(args.originals_folder + 'cache.sqlite') if args.originals_folder else None
+    page_store = mk_page_store() if args.originals_folder else None
+    page_history = PageHistory(args.originals_folder + 'history.sqlite') if args.originals_folder and (args.history or args.as_of) else None
+
+    if args.migrate_to_pack:
+        migrate_to_pack()
+        page_store.close()
+        sys.exit(0)
+    if args.rebuild_manifest:
+        rebuild_manifest()
+        page_store.close()
+        sys.exit(0)
+    if args.fsck:
+        fsck()
+        page_store.close()
+        sys.exit(0)
+    if cache_db and cache_db.created and not page_store.house_ids():
+        cache_db.set_manifest_complete() # empty originals folder, all the pages will be recorded
+    if page_store and (args.cache_maint or args.cache_max_size is not None or args.cache_max_age is not None):
+        fits = maintain_cache()
+        if args.cache_maint:
+            page_store.close()
+            sys.exit(0 if fits else 4)
+    cache_quota = CacheQuota() if page_store and args.cache_max_size is not None and not args.cache_only else None
+
     #init errors.log
     f_errors = open('errors.txt','wb')
     f_ids = open('ids.txt','wb')
 
     # data extractor intialization
-    if args.extractor == 'original':
+    if args.extractor in ('original', 'lxml'):
         #init csv for housedata
         fieldnames_data = ('LAT','LON','HOUSE_ID','ADDRESS','YEAR','LASTUPDATE','SERVICEDATE_START','SERIE','HOUSE_TYPE','CAPFOND','MGMT_COMPANY','MGMT_COMPANY_LINK','AVAR','LEVELS_MAX','LEVELS_MIN','DOORS','ROOM_COUNT','ROOM_COUNT_LIVE','ROOM_COUNT_NONLIVE','AREA','AREA_LIVE','AREA_NONLIVE','AREA_GEN','AREA_LAND','AREA_PARK','CADNO','ENERGY_CLASS','BLAG_PLAYGROUND','BLAG_SPORT','BLAG_OTHER','OTHER')
 
     elif args.extractor == 'attrlist':
         # load csv file with attribute descriptions
-        attrlist = load_attrlist()
+        attrlist_plan = compile_attrlist(load_attrlist())
+        attrlist_matcher = SelectorMatcher([ s for rule in attrlist_plan for s in (rule.name_selector, rule.value_selector) ])
         fieldnames_data = ('REGION', 'HOUSE_ID','ATTR_NAME','FOUND_NAME','ED_DIST','VALUE')
         fieldnames_type = ('TEXT', 'TEXT','TEXT','TEXT','INTEGER','TEXT')
         fieldnames_phld = ', '.join([ ':' + s for s in fieldnames_data]) #placeholder for sqlite
@@ -667,7 +2689,7 @@ if __name__ == '__main__':
             try:
                 conn = psycopg2.connect(args.output_name)
                 pgcur = conn.cursor()
-                pgquery = 'insert into attrvals_all(region, house_id, attr_name, found_name, ed_dist, value) values %s'
+                pgquery = 'insert into attrvals_all(region, house_id, attr_name, found_name, ed_dist, value' + (', ts' if args.as_of else '') + ') values %s'
             except psycopg2.Error as e:
                 print 'Failed to open database connection to', args.output_name, e
                 sys.exit(6)
@@ -680,19 +2702,46 @@ if __name__ == '__main__':
         res = get_housedata(house_link,str(args.id),None,None,None,None)
         if res == False:
             print 'Building data was not retrieved for id=', args.id
+    elif args.houseids_file:
+        houses_ids = [ line.strip() for line in open(args.houseids_file) if line.strip() ]
+        print len(houses_ids), 'house_ids will be processed'
+        i = process_houses([ (house_id, (None,) * 6) for house_id in houses_ids ])
+        print 'Processed', i, 'house_ids'
+    elif args.allfiles and args.as_of:
+        houses_ids = page_history.house_ids()
+        print len(houses_ids), 'buildings in the history'
+        for house_id in houses_ids:
+            res = get_housedata(house_link,str(house_id),None,None,None,None)
+            if res == False:
+                print 'Building data was not retrieved for id=', house_id
     elif args.allfiles:
-        for f in glob.glob(args.originals_folder + '/*.html'):
-            mtch = re.search(r'(\d{7})\.html$', f)
-            if mtch:
-                house_id = mtch.group(1)
-                print 'Processing cached file', f, 'id', house_id
+        if cache_db.manifest_complete():
+            houses_ids = cache_db.house_ids_with_status('valid')
+            print len(houses_ids), 'valid pages in the manifest'
+        else:
+            print 'Manifest is not complete, listing the cache (see --rebuild_manifest)'
+            houses_ids = page_store.house_ids()
+        if page_history:
+            cached = set(houses_ids)
+            evicted = [ house_id for house_id in page_history.house_ids() if house_id not in cached and not page_store.has(house_id) ]
+            print len(evicted), 'more buildings in the history'
+            houses_ids += evicted
+        houses_ids = page_store.scan_order(houses_ids) # sequential reading of the packs
+        if parallel_extraction:
+            i = extract_houses(houses_ids)
+            print 'Processed', i, 'house_ids'
+        else:
+            for i, house_id in enumerate(houses_ids, 1):
+                print 'Processing cached page', page_store.location(house_id), 'id', house_id
                 res = get_housedata(house_link,str(house_id),None,None,None,None)
                 if res == False:
                     print 'Building data was not retrieved for id=', house_id
-            else:
-                print 'No house_id in ', f
+                if i % 1000 == 0:
+                    cache_db.commit()
+            cache_db.commit()
     else:
         regs = get_data_links(args.id)
+        region_houses = [] # (region, houses_ids) for --schedule staleness
 
         for reg in regs:
             if reg[5] != '' or len([i for i in regs if reg[4] in i]) == 1: #can't use Counter with cnt(elem[4] for elem in regs)[reg[4]] because of the progressbar
@@ -700,47 +2749,85 @@ if __name__ == '__main__':
                 # get list of houses
                 tid = reg[5] if reg[5] else reg[4]
                 print 'Effective tid:', tid
-                house_ids_fname = args.originals_folder + dirsep + 'house_ids-' + str(tid) + '.pickle'
+                house_ids_fname = house_list_file_name(tid)
 
-                if args.reload_list and os.path.isfile(house_ids_fname):
-                    out_of_the_way(house_ids_fname)
-
-                if os.path.isfile(house_ids_fname):
-                    print 'Loading cached house_ids from ', house_ids_fname
-                    f_house_ids = open(house_ids_fname, 'rb')
-                    houses_ids = pickle.load(f_house_ids)
-                    f_house_ids.close()
-                elif args.cache_only:
-                    print 'No cached house_ids for requested tid', house_ids_fname
-                    sys.exit(3)
-                else:
+                houses_ids = load_house_list(tid)
+                added = [] # new in the reloaded list, processed first
+                if houses_ids is None:
+                    if args.cache_only:
+                        print 'No cached house_ids for requested tid', house_ids_fname
+                        sys.exit(3)
                     print 'Retrieve house ids from the site'
-                    houses_ids = get_house_list('http://www.reformagkh.ru/myhouse/list?tid=' + tid)
+                    houses_ids, reported = get_house_list(args.site + '/myhouse/list?tid=' + tid)
+                    previous_ids = read_house_list(house_ids_fname)[0] if os.path.isfile(house_ids_fname) else None
 
                     # save IDs in a file making a copy of an existing file
                     print 'Saving house_ids to ', house_ids_fname
-                    f_house_ids = open(house_ids_fname, 'wb')
-                    pickle.dump(houses_ids, f_house_ids)
-                    f_house_ids.close()
+                    out_of_the_way(house_ids_fname)
+                    write_house_list(house_ids_fname, tid, houses_ids, reported)
+                    houses_ids = sorted(set(houses_ids), key=int)
+
+                    if previous_ids is not None:
+                        added, removed, unchanged = diff_house_lists(previous_ids, houses_ids)
+                        print 'Compared with the previous list:', len(added), 'added,', len(removed), 'removed,', len(unchanged), 'unchanged'
+                        record_removed(tid, removed, added)
+                        houses_ids = added if args.delta_only else added + unchanged
 
                 #pbar = ProgressBar(widgets=[Bar('=', '[', ']'), ' ', Counter(), ' of ' + str(len(houses_ids)), ' ', ETA()]).start()
                 #pbar.maxval = len(houses_ids)
 
+                if args.fast_check and cache_db and cache_db.manifest_complete():
+                    houses_ids = cache_db.pending(houses_ids)
+                    print len(houses_ids), 'house_ids have no valid cached page'
+
+                if args.schedule == 'staleness':
+                    region_houses.append((reg, houses_ids))
+                    continue
+
                 print len(houses_ids),'house_ids will be processed'
-                if args.shuffle:
-                    random.shuffle(houses_ids)
-                i = 0
-                for house_id in houses_ids:
-                    i = i+1
-                    print i, '\tProcessing house_id', house_id
-                    res = get_housedata(house_link,str(house_id),reg[0],reg[3],reg[1],reg[4])
-                    if res == False:
-                        print 'Building data was not retrieved for id=', house_id
-                    #pbar.update(pbar.currval+1)
+                if args.schedule == 'shuffle':
+                    # the new buildings stay first
+                    added = set(added)
+                    first, rest = [ h for h in houses_ids if h in added ], [ h for h in houses_ids if h not in added ]
+                    random.shuffle(first)
+                    random.shuffle(rest)
+                    houses_ids = first + rest
+                i = process_houses([ (house_id, reg) for house_id in houses_ids ])
+                #pbar.update(pbar.currval+1)
                 print 'Processed', i, 'house_ids'
                 #pbar.finish()
 
-    if args.extractor == 'original':
+        if region_houses:
+            i = process_houses(schedule_houses(region_houses))
+            print 'Processed', i, 'house_ids'
+
+    print 'Timings:', timings.stats()
+    if args.extractor == 'attrlist' and not parallel_extraction: # the worker processes have their own memo
+        print 'Edit distance:', edit_distance.stats()
+    if not args.cache_only:
+        print 'Requests:', retry_policy.stats()
+    if not args.no_tor:
+        print 'Tor circuits:'
+        for tor in tor_pool.instances:
+            print '\t' + tor.stats()
+            tor.close()
+    if args.aimd and not args.cache_only:
+        print 'Request rates:'
+        for governor in [direct_governor] if args.no_tor else [ tor.governor for tor in tor_pool.instances ]:
+            print '\t' + governor.stats()
+
+    if extraction:
+        extraction['pool'].close()
+        extraction['pool'].join()
+    if cache_db:
+        cache_db.commit()
+    if page_store:
+        page_store.close()
+    if page_history:
+        page_history.close()
+    if args.verify_extractor:
+        print 'Extractor verification:', extractor_verification['pages'], 'pages,', extractor_verification['differ'], 'differ'
+    if args.extractor in ('original', 'lxml'):
         f_housedata.close()
     f_errors.close()
     f_ids.close()
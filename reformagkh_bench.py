@@ -0,0 +1,142 @@
+#!/usr/bin/env python -u
+# -*- coding: utf-8 -*-
+
+#******************************************************************************
+#
+# reformagkh_bench.py
+# ---------------------------------------------------------
+# Offline throughput benchmark of get_reformagkh_data-all.py: starts reformagkh_stub_server.py,
+# downloads a region from it into a temporary originals folder, then re-extracts the region
+# from the cache (--allfiles) and reports pages/s, parse and write time of both runs.
+# More: https://github.com/nextgis/reformagkh
+#
+# Usage:
+#      usage: reformagkh_bench.py [-h] [-of ORIGINALS_FOLDER] [--houses N] [--runs N] [-- GRABBER_ARGS]
+#      where:
+#           -h           show this help message and exit
+#           -of ORIGINALS_FOLDER  serve these cached pages instead of the synthetic ones
+#           --houses N   number of synthetic houses (default 500)
+#           --runs N     repeat the benchmark N times (default 1)
+#           --latency, --captcha, --bad_gateway, --timeout, --maintenance, --conditional
+#                        passed to the stub server
+#           --keep       do not remove the working folder
+#           GRABBER_ARGS passed to both runs of the grabber, e.g. -- --workers 8 --extractor attrlist
+# Examples:
+#      python reformagkh_bench.py --houses 1000 --latency 0.1 -- --workers 8
+#
+# Copyright (C) 2014-2016 Maxim Dubinin (sim@gis-lab.info)
+# Created: 17.10.2026
+#
+# This source is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# This code is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# A copy of the GNU General Public License is available on the World Wide Web
+# at <http://www.gnu.org/copyleft/gpl.html>. You can also obtain it by writing
+# to the Free Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+#******************************************************************************
+
+import argparse
+import subprocess
+import tempfile
+import shutil
+import socket
+import time
+import re
+import os
+import sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-of','--originals_folder', help='Folder with the original html files to serve')
+parser.add_argument('--houses', help='number of synthetic houses', type=int, default=500)
+parser.add_argument('--runs', help='number of benchmark runs', type=int, default=1)
+parser.add_argument('--latency', help='average response delay of the stub server, seconds', default='0')
+parser.add_argument('--captcha', help='probability of a captcha page', default='0')
+parser.add_argument('--bad_gateway', help='probability of a 502 Bad Gateway page', default='0')
+parser.add_argument('--timeout', help='probability of a 504 Gateway Time-out page', default='0')
+parser.add_argument('--maintenance', help='probability of a maintenance page', default='0')
+parser.add_argument('--conditional', help='stub server answers 304 Not Modified to conditional requests', action="store_true")
+parser.add_argument('--keep', help='do not remove the working folder', action="store_true")
+parser.add_argument('grabber_args', help='arguments for get_reformagkh_data-all.py', nargs=argparse.REMAINDER)
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+tid = '1000' # region of the atd.csv written for the benchmark
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_stub_server(port):
+    cmd = [ sys.executable, os.path.join(script_dir, 'reformagkh_stub_server.py'), '--port', str(port), '--houses', str(args.houses),
+            '--latency', args.latency, '--captcha', args.captcha, '--bad_gateway', args.bad_gateway,
+            '--timeout', args.timeout, '--maintenance', args.maintenance ]
+    if args.originals_folder:
+        cmd += [ '-of', os.path.abspath(args.originals_folder) ]
+    if args.conditional:
+        cmd.append('--conditional')
+    server = subprocess.Popen(cmd, stdout=open(os.devnull, 'wb'))
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.kill()
+    print 'Stub server did not start'
+    sys.exit(1)
+
+def run_grabber(workdir, site, extra_args):
+    """Runs the grabber, returns wall time and its Timings line parsed into a dict"""
+    cmd = [ sys.executable, os.path.join(script_dir, 'get_reformagkh_data-all.py'), tid, 'housedata.csv',
+            '-of', 'originals', '--no_tor', '--site', site, '--outputmode', 'overwrite' ] + extra_args + grabber_args
+    log = open(os.path.join(workdir, 'grabber.log'), 'ab')
+    start = time.time()
+    status = subprocess.call(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.time() - start
+    log.close()
+    timings = {}
+    for line in open(os.path.join(workdir, 'grabber.log'), 'rb'):
+        if line.startswith('Timings:'):
+            timings = dict(re.findall(r'(\S+)=([\d.]+)', line))
+    if status != 0:
+        print 'Grabber exited with status', status, 'see', os.path.join(workdir, 'grabber.log')
+    return wall, timings
+
+def report(name, wall, timings):
+    pages = int(timings.get('pages', 0))
+    print '%-10s pages %6d  wall %8.2fs  pages/s %8.2f  fetch %8.2fs  parse %8.2fs  extract %8.2fs  write %8.2fs' % (
+        name, pages, wall, pages / wall if wall else 0, float(timings.get('fetch', 0)), float(timings.get('parse', 0)),
+        float(timings.get('extract', 0)), float(timings.get('write', 0)))
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    grabber_args = [ a for a in args.grabber_args if a != '--' ]
+    port = free_port()
+    site = 'http://127.0.0.1:%d' % port
+    server = start_stub_server(port)
+    try:
+        for run in range(args.runs):
+            workdir = tempfile.mkdtemp(prefix='reformagkh-bench-')
+            f_atd = open(os.path.join(workdir, 'atd.csv'), 'wb')
+            f_atd.write('Benchmark,Benchmark city,,100,%s,\n' % tid)
+            f_atd.close()
+            print 'Run', run + 1, 'of', args.runs, 'in', workdir
+            wall, timings = run_grabber(workdir, site, [])
+            report('download', wall, timings)
+            wall, timings = run_grabber(workdir, site, ['--allfiles'])
+            report('cache', wall, timings)
+            if not args.keep:
+                shutil.rmtree(workdir)
+    finally:
+        server.terminate()
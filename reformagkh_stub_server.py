@@ -0,0 +1,290 @@
+#!/usr/bin/env python -u
+# -*- coding: utf-8 -*-
+
+#******************************************************************************
+#
+# reformagkh_stub_server.py
+# ---------------------------------------------------------
+# Local stand-in for reformagkh.ru: serves the lists of the buildings, the house pages
+# and the ATD pages from an originals folder or from synthetic fixtures, optionally with
+# latency, captchas, 502, time outs and maintenance pages injected. Used to test and
+# benchmark get_reformagkh_data-all.py offline (see reformagkh_bench.py).
+# More: https://github.com/nextgis/reformagkh
+#
+# Usage:
+#      usage: reformagkh_stub_server.py [-h] [-of ORIGINALS_FOLDER] [--houses N] [--port PORT]
+#      where:
+#           -h           show this help message and exit
+#           -of ORIGINALS_FOLDER  serve cached pages (plain, .gz, .zst or the pack store) from this folder
+#           --houses N   number of synthetic houses when no originals folder is given (default 1000)
+#           --host, --port  address to listen at (default 127.0.0.1:8080)
+#           --latency S  average delay of a response, seconds (uniformly distributed in 0..2*S)
+#           --captcha P, --bad_gateway P, --timeout P, --maintenance P
+#                        probability of a captcha, 502 Bad Gateway, 504 Gateway Time-out or
+#                        maintenance page instead of a house page
+#           --conditional answer 304 Not Modified to the conditional requests
+# Examples:
+#      python reformagkh_stub_server.py --houses 500 --latency 0.2 --captcha 0.01
+#      python get_reformagkh_data-all.py 1000 housedata.csv -of stub --no_tor --site http://127.0.0.1:8080
+#
+# Copyright (C) 2014-2016 Maxim Dubinin (sim@gis-lab.info)
+# Created: 17.10.2026
+#
+# This source is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 2 of the License, or (at your option)
+# any later version.
+#
+# This code is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# A copy of the GNU General Public License is available on the World Wide Web
+# at <http://www.gnu.org/copyleft/gpl.html>. You can also obtain it by writing
+# to the Free Software Foundation, Inc., 59 Temple Place - Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+#******************************************************************************
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import urlparse
+import hashlib
+import random
+import time
+import gzip
+import zlib
+import sqlite3
+import glob
+import re
+import os
+import sys
+try:
+    import zstandard # optional, only needed to serve .zst pages
+except ImportError:
+    zstandard = None
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-of','--originals_folder', help='Folder with the original html files to serve')
+parser.add_argument('--houses', help='number of synthetic houses', type=int, default=1000)
+parser.add_argument('--host', help='address to listen at', default='127.0.0.1')
+parser.add_argument('--port', help='port to listen at', type=int, default=8080)
+parser.add_argument('--latency', help='average response delay, seconds', type=float, default=0)
+parser.add_argument('--captcha', help='probability of a captcha page', type=float, default=0)
+parser.add_argument('--bad_gateway', help='probability of a 502 Bad Gateway page', type=float, default=0)
+parser.add_argument('--timeout', help='probability of a 504 Gateway Time-out page', type=float, default=0)
+parser.add_argument('--maintenance', help='probability of a maintenance page', type=float, default=0)
+parser.add_argument('--conditional', help='answer 304 Not Modified to conditional requests', action="store_true")
+
+captcha_page = u'''<html><head><title>Реформа ЖКХ</title></head><body>
+<p>Каптча: превышен лимит запросов</p>
+<form name="request_limiter_captcha" method="post"><img src="/captcha.png"/><input name="code"/></form>
+</body></html>'''.encode('utf-8')
+
+bad_gateway_page = '''<html>
+<head><title>502 Bad Gateway</title></head>
+<body bgcolor="white">
+<center><h1>502 Bad Gateway</h1></center>
+<hr><center>nginx</center>
+</body>
+</html>'''
+
+timeout_page = '''<html>
+<head><title>504 Gateway Time-out</title></head>
+<body bgcolor="white">
+<center><h1>504 Gateway Time-out</h1></center>
+<hr><center>nginx</center>
+</body>
+</html>'''
+
+maintenance_page = u'''<html><head><title>Реформа ЖКХ</title></head><body>
+<h1>Технические работы</h1><p>Сайт временно недоступен</p>
+</body></html>'''.encode('utf-8')
+
+def site_chrome(title):
+    """Menus, scripts and footer around the content, as heavy as on the real site"""
+    menu = u''.join(u'<li><a href="/section/%d">Раздел %d</a><ul>%s</ul></li>' % (i, i,
+                   u''.join(u'<li><a href="/section/%d/%d">Подраздел %d</a></li>' % (i, j, j) for j in range(10)))
+                   for i in range(20))
+    header = (u'<!DOCTYPE html><html><head><meta charset="utf-8"/><title>%s</title>'
+              u'<link rel="stylesheet" href="/css/main.css"/></head><body>'
+              u'<div id="header"><ul class="menu">%s</ul></div><div id="content">' % (title, menu))
+    footer = u'<div id="footer">%s</div></div></body></html>' % (u'<p>Реформа ЖКХ, все права защищены.</p>' * 30)
+    return header, footer
+
+def synthetic_lastupdate(rnd):
+    return '%02d.%02d.%d' % (rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(2013, 2016))
+
+def synthetic_house_page(house_id):
+    """House page with the layout the extractors of get_reformagkh_data-all.py expect"""
+    rnd = random.Random(int(house_id))
+    header, footer = site_chrome(u'Реформа ЖКХ')
+    address = u'г. Тестовый, ул. Синтетическая, д. %d' % (int(house_id) % 300 + 1)
+
+    general = [ (u'Домом управляет', u'<a href="/mymanager/profile/view/%d?tid=1">ООО "УК %d"</a>' % (rnd.randint(1000, 9999), rnd.randint(1, 99))) ]
+    general2 = [ (u'Параметр %d' % i, u'значение %d' % rnd.randint(1, 100)) for i in range(11) ]
+    general2[2] = (u'Общая площадь', u'%d,%d' % (rnd.randint(500, 20000), rnd.randint(0, 9)))
+    general2[6] = (u'Год ввода в эксплуатацию', u'%d' % rnd.randint(1900, 2015))
+    general2[8] = (u'Последнее изменение анкеты', u'\n  %s в %02d:%02d\n  ' % (synthetic_lastupdate(rnd), rnd.randint(0, 23), rnd.randint(0, 59)))
+    general2[10] = (u'Дата начала обслуживания дома', u'%02d.%02d.%d' % (rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(2006, 2015)))
+    rows = lambda pairs: u''.join(u'<tr><td>%s</td><td>%s</td></tr>' % p for p in pairs)
+    fr = u'<div class="fr"><table>%s</table><table>%s</table></div>' % (rows(general), rows(general2))
+
+    # passport: the rows are numbered the way parse_house_page_original reads them,
+    # row 12 holds a nested table with the number of levels (rows 13-16)
+    passport = []
+    n = 0
+    while n < 58:
+        if n == 12:
+            passport.append(u'<tr><td>Количество этажей</td><td><table><tr><td>наибольшее</td></tr><tr><td>%d</td></tr>'
+                            u'<tr><td>наименьшее</td></tr><tr><td>%d</td></tr></table></td></tr>' % (rnd.randint(5, 25), rnd.randint(1, 5)))
+            n += 5
+        else:
+            passport.append(u'<tr><td>Показатель %d</td><td>%d %03d</td></tr>' % (n, rnd.randint(0, 9), rnd.randint(0, 999)))
+            n += 1
+    numbered = u'<div class="numbered"><table>%s</table></div><div class="numbered"><table>%s</table></div>' % (
+        u''.join(passport), rows([ (u'Конструктивный элемент %d' % i, u'тип %d' % rnd.randint(1, 5)) for i in range(30) ]))
+
+    scripts = u''.join(u'<script type="text/javascript">var widget%d = {"id": %d};</script>\n' % (i, i) for i in range(12))
+    scripts += (u'<script type="text/javascript">\nymaps.ready(function () {\n    var map = new ymaps.Map("map", {\n'
+                u'        center: [%.6f, %.6f],\n        zoom: 16\n    });\n});\n</script>\n' % (55 + rnd.random(), 37 + rnd.random()))
+
+    content = (u'<span class="float-left loc_name_ohl width650 word-wrap-break-word">\n %s\n</span>' % address) + fr + numbered + scripts
+    return (header + content + footer).encode('utf-8')
+
+def list_page(tid, houses_ids, lastupdates, total):
+    """List of the buildings as parsed by check_size and get_house_list"""
+    header, footer = site_chrome(u'Реформа ЖКХ')
+    summary = (u'<div class="clearfix"></div><div class="clearfix"><table class="col_list"><tr><td>Регион</td><td>%s</td>'
+               u'<td>Количество домов</td><td>%d ед.</td></tr></table></div>' % (tid, total))
+    rows = u''.join(u'<tr><td><a href="/myhouse/profile/view/%s/">дом %s</a></td><td>%s</td></tr>' % (house_id, house_id, lastupdates(house_id))
+                    for house_id in houses_ids)
+    return (header + summary + u'<table class="houses">%s</table>' % rows + footer).encode('utf-8')
+
+def atd_page(tid):
+    """ATD level page as parsed by get_reformagkh_atd-v2.py: links to three sublevels"""
+    header, footer = site_chrome(u'Реформа ЖКХ')
+    links = u''.join(u'<tr><td><a href="?tid=%s%d&sort=alphabet">Территория %s%d</a></td></tr>' % (tid, i, tid, i) for i in range(1, 4))
+    return (header + u'<table class="col_list ">%s</table>' % links + footer).encode('utf-8')
+
+class HouseSource(object):
+    """House pages either from the originals folder or synthetic"""
+
+    def __init__(self, originals_folder, houses):
+        self.files = {}
+        self.pack_folder = None
+        if originals_folder and os.path.isfile(os.path.join(originals_folder, 'pack', 'index.sqlite')):
+            # pack store of get_reformagkh_data-all.py, see PackStore there
+            self.pack_folder = os.path.join(originals_folder, 'pack')
+            conn = sqlite3.connect(os.path.join(self.pack_folder, 'index.sqlite'))
+            self.files = dict((row[0], row[1:]) for row in conn.execute('select house_id, pack, offset, length, codec from pages'))
+            conn.close()
+            self.houses_ids = sorted(self.files)
+        elif originals_folder:
+            for fname in glob.glob(os.path.join(originals_folder, '*.html*')):
+                mtch = re.search(r'(\d{7})\.html(\.gz|\.zst)?$', fname)
+                if mtch:
+                    self.files[mtch.group(1)] = fname
+            self.houses_ids = sorted(self.files)
+        else:
+            self.houses_ids = [ str(1000000 + i) for i in range(houses) ]
+        self.known = set(self.houses_ids)
+
+    def page(self, house_id):
+        if not self.files:
+            return synthetic_house_page(house_id) if house_id in self.known else None
+        fname = self.files.get(house_id)
+        if fname is None:
+            return None
+        if self.pack_folder:
+            pack, offset, length, codec = fname
+            f = open(os.path.join(self.pack_folder, pack), 'rb')
+            f.seek(offset)
+            data = f.read(length)
+            f.close()
+            if codec == 1:
+                return zlib.decompress(data)
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data) if codec == 2 else data
+        f = gzip.open(fname, 'rb') if fname.endswith('.gz') else open(fname, 'rb')
+        data = f.read()
+        f.close()
+        if fname.endswith('.zst'):
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        return data
+
+    def lastupdate(self, house_id):
+        return synthetic_lastupdate(random.Random(int(house_id))) if not self.files else ''
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, as the real site
+
+    def do_GET(self):
+        if args.latency:
+            time.sleep(random.uniform(0, 2 * args.latency))
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        mtch = re.match(r'^/myhouse/profile/view/(\d+)/?$', url.path)
+
+        if mtch:
+            self.house(mtch.group(1))
+        elif url.path == '/myhouse/list' and 'tid' in query:
+            limit = int(query.get('limit', 10))
+            page = int(query.get('page', 1))
+            houses_ids = source.houses_ids[(page - 1) * limit:page * limit]
+            self.reply(200, list_page(query['tid'], houses_ids, source.lastupdate, len(source.houses_ids)))
+        elif url.path == '/myhouse':
+            self.reply(200, atd_page(query.get('tid', '')))
+        elif url.path == '/':
+            self.reply(200, '<html><body>reformagkh stub server</body></html>')
+        else:
+            self.reply(404, '<html><body>404 Not Found</body></html>')
+
+    def house(self, house_id):
+        chance = random.random()
+        for probability, status, page in ((args.captcha, 200, captcha_page),
+                                          (args.bad_gateway, 502, bad_gateway_page),
+                                          (args.timeout, 504, timeout_page),
+                                          (args.maintenance, 200, maintenance_page)):
+            if chance < probability:
+                # the maintenance page comes without charset, like on the real site
+                return self.reply(status, page, 'text/html' if page is maintenance_page else None)
+            chance -= probability
+
+        page = source.page(house_id)
+        if page is None:
+            return self.reply(404, '<html><body>404 Not Found</body></html>')
+        etag = '"%s"' % hashlib.md5(page).hexdigest()
+        if args.conditional and self.headers.get('If-None-Match') == etag:
+            return self.reply(304, '', headers={'ETag': etag})
+        self.reply(200, page, headers={'ETag': etag} if args.conditional else {})
+
+    def reply(self, status, body, content_type=None, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type or 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # one line per request is too much for a benchmark
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.originals_folder and zstandard is None and glob.glob(os.path.join(args.originals_folder, '*.html.zst')):
+        print 'zstandard module is required to serve .zst pages'
+        sys.exit(-1)
+    source = HouseSource(args.originals_folder, args.houses)
+    server = StubServer((args.host, args.port), StubHandler)
+    print 'Serving', len(source.houses_ids), 'houses at http://%s:%d' % (args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass